@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Measures the startup time of the pt command and checks that the modules which are
+only needed by some commands are not imported before a command is invoked.
+
+Usage: python benchmarks/startup.py [RUNS] [MAX_MS]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+# Modules which must be imported lazily
+LAZY_MODULES = ['cookiecutter', 'webbrowser', 'dns', 'progressbar', 'pyarrow', 'watchdog', 'termcolor',
+                'pt.service', 'pt.commands.build', 'pt.commands.docker', 'pt.commands.test', 'pt.commands.upgrade']
+
+CODE = """
+import sys, time
+start = time.time()
+import pt.pt
+pt.commands.init_plugins(pt.pt.papertrail)
+sys.stdout.write('%%f\\n' %% (time.time() - start))
+sys.stdout.write(' '.join(m for m in %r if m in sys.modules))
+""" % LAZY_MODULES
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    totals = []
+    imports = []
+    loaded = ''
+    for i in range(runs):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, '-c', CODE], cwd=root)
+        totals.append(time.time() - start)
+        lines = out.decode('utf-8').split('\n')
+        imports.append(float(lines[0]))
+        loaded = lines[1].strip()
+
+    totals.sort()
+    imports.sort()
+    print('process: min %.1f ms, median %.1f ms' % (totals[0] * 1000, totals[len(totals) // 2] * 1000))
+    print('import:  min %.1f ms, median %.1f ms' % (imports[0] * 1000, imports[len(imports) // 2] * 1000))
+
+    failed = False
+    if loaded:
+        print('eagerly imported: %s' % loaded)
+        failed = True
+    if max_ms is not None and totals[len(totals) // 2] * 1000 > max_ms:
+        print('median startup time exceeds %.1f ms' % max_ms)
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
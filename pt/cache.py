@@ -0,0 +1,421 @@
+"""
+On-disk caches of PQL query results and downloaded artifacts.
+
+PQL entries are keyed by the host, the user and the normalized query and stored
+as length-prefixed frames of zlib-compressed marshal dumps: the response without its items,
+then batches of rows, written and read as the rows stream. Each file starts with the time
+the entry was created, which is checked against the TTL; the file modification time is bumped
+on every hit and is used to evict the least recently used entries once the cache exceeds its size cap.
+
+Artifacts (installers and CI packages) are stored by the SHA-256 of their content,
+with an index mapping build numbers or URLs to the content hashes.
+
+Build entries record a fingerprint of the inputs of each project build, and the
+outputs of the last builds are kept in the artifact cache to be restored when
+the inputs hash the same again.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import shutil
+import struct
+import marshal
+import hashlib
+import itertools
+import threading
+
+from transfer import download_file, file_checksum
+from utils import atomic_write
+
+CACHE_DIR = os.getenv('PT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.pt', 'cache'))
+TTL = 300  # seconds
+MAX_SIZE = 100 * 1024 * 1024  # bytes
+BATCH_ROWS = 1000  # rows per frame
+ARTIFACTS_MAX_SIZE = int(os.getenv('PT_ARTIFACT_CACHE_SIZE', 2 * 1024)) * 1024 * 1024  # megabytes
+BUILD_HISTORY = 5  # builds with stored outputs per project
+
+HEADER = struct.Struct('>d')
+FRAME = struct.Struct('>I')
+
+
+# Quoted literals, with quotes escaped by doubling them
+LITERAL = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_query(query):
+    """Collapses whitespace outside quoted literals and drops a trailing semicolon."""
+    # Odd parts are the literals
+    parts = LITERAL.split(query)
+    query = ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+    return query.strip().rstrip(';').strip()
+
+
+def write_frame(f, value):
+    """Writes a frame of VALUE to F, returns its size."""
+    data = zlib.compress(marshal.dumps(value))
+    f.write(FRAME.pack(len(data)) + data)
+    return FRAME.size + len(data)
+
+
+def read_frames(f):
+    """Yields the values of the frames left in F and closes it."""
+    try:
+        while True:
+            header = f.read(FRAME.size)
+            if not header:
+                break
+            length, = FRAME.unpack(header)
+            yield marshal.loads(zlib.decompress(f.read(length)))
+    finally:
+        f.close()
+
+
+def evict_lru(directory, max_size):
+    """
+    Removes the least recently used files of DIRECTORY, by modification time,
+    until their total size fits MAX_SIZE. Returns the names of the removed files.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(directory):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total += stat.st_size
+
+    removed = set()
+    for mtime, size, name in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+            total -= size
+            removed.add(name)
+        except OSError:
+            pass
+    return removed
+
+
+class _EntryTooLarge(Exception):
+    pass
+
+
+class PqlCache:
+
+    def __init__(self, directory=None, ttl=TTL, max_size=MAX_SIZE):
+        self.directory = directory or os.path.join(CACHE_DIR, 'pql')
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def path(self, client, query):
+        key = '\0'.join([client.url, client.username or '', normalize_query(query)])
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, client, query):
+        """
+        Returns a cached response or None if there's no fresh entry.
+        Its items are read from the entry as they're iterated.
+        """
+        path = self.path(client, query)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            created, = HEADER.unpack(f.read(HEADER.size))
+            if time.time() - created > self.ttl:
+                f.close()
+                return None
+            frames = read_frames(f)
+            data = next(frames)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, EOFError, StopIteration, struct.error, zlib.error):
+            f.close()
+            return None
+
+        data['items'] = itertools.chain.from_iterable(frames)
+        return data
+
+    def put(self, client, query, data):
+        """Stores a fully materialized response."""
+        head = dict(data)
+        rows = head.pop('items')
+        with atomic_write(self.path(client, query)) as f:
+            f.write(HEADER.pack(time.time()))
+            write_frame(f, head)
+            for i in range(0, len(rows), BATCH_ROWS):
+                write_frame(f, rows[i:i + BATCH_ROWS])
+
+        self.evict()
+
+    def wrap(self, client, query, data):
+        """
+        Stores a response as its items are consumed.
+        Streamed items are written to the entry in batches, giving up once it exceeds the cache size.
+        The entry is only stored if all the items were consumed.
+        """
+        items = data.get('items')
+        if items is None:
+            return data
+
+        if isinstance(items, list):
+            self.put(client, query, data)
+            return data
+
+        head = dict(data)
+        del head['items']
+
+        def collect(items):
+            try:
+                with atomic_write(self.path(client, query)) as f:
+                    f.write(HEADER.pack(time.time()))
+                    size = write_frame(f, head)
+                    rows = []
+                    for row in items:
+                        if size is not None:
+                            rows.append(row)
+                            if len(rows) == BATCH_ROWS:
+                                size += write_frame(f, rows)
+                                rows = []
+                                if size > self.max_size:
+                                    size = None
+                        yield row
+
+                    if size is None:
+                        raise _EntryTooLarge()
+                    write_frame(f, rows)
+            except _EntryTooLarge:
+                return
+
+            self.evict()
+
+        data['items'] = collect(items)
+        return data
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits MAX_SIZE."""
+        evict_lru(self.directory, self.max_size)
+
+
+class ArtifactCache:
+
+    def __init__(self, directory=None, max_size=ARTIFACTS_MAX_SIZE):
+        self.directory = directory or os.path.join(CACHE_DIR, 'artifacts')
+        self.objects = os.path.join(self.directory, 'objects')
+        self.index_file = os.path.join(self.directory, 'index.json')
+        self.max_size = max_size
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        with atomic_write(self.index_file, 'wt') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+    def get(self, key):
+        """Returns the path of the cached artifact stored under KEY or None."""
+        digest = self.load_index().get(key)
+        if digest is None:
+            return None
+
+        path = os.path.join(self.objects, digest)
+        if not os.path.exists(path):
+            return None
+
+        os.utime(path, None)
+        return path
+
+    def put(self, key, path):
+        """Stores a copy of the file at PATH under KEY."""
+        self.put_all([(key, path)])
+
+    def put_all(self, files):
+        """Stores copies of FILES, (key, path) pairs, updating the index and evicting once."""
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+
+        digests = {}
+        for key, path in files:
+            digest = file_checksum(path, 'sha256')
+            dest = os.path.join(self.objects, digest)
+            if not os.path.exists(dest):
+                with open(path, 'rb') as source, atomic_write(dest) as f:
+                    shutil.copyfileobj(source, f)
+            else:
+                os.utime(dest, None)
+            digests[key] = digest
+
+        index = self.load_index()
+        index.update(digests)
+        self.save_index(index)
+
+        self.evict()
+
+    def fetch(self, key, url, output, **kwargs):
+        """
+        Copies the artifact stored under KEY to OUTPUT, or downloads it from URL
+        and stores it if it's not cached. KWARGS are passed to download_file.
+        """
+        path = self.get(key)
+        if path is not None:
+            shutil.copyfile(path, output)
+            return output
+
+        download_file(url, output, **kwargs)
+        self.put(key, output)
+        return output
+
+    def evict(self):
+        """Removes the least recently used artifacts until the cache fits MAX_SIZE."""
+        removed = evict_lru(self.objects, self.max_size)
+        if removed:
+            index = self.load_index()
+            self.save_index({key: digest for key, digest in index.items() if digest not in removed})
+
+
+class BuildCache:
+    """
+    Build states are kept per KIND of builder (its class name) and PROJECT directory,
+    as builders of different kinds may build the same directory.
+    """
+
+    # Builds run concurrently but share the artifact index
+    lock = threading.Lock()
+    state_locks = {}
+
+    def __init__(self, directory=None, artifacts=None, history=BUILD_HISTORY):
+        self.directory = directory or os.path.join(CACHE_DIR, 'builds')
+        self.artifacts = artifacts or ArtifactCache()
+        self.history = history
+
+    def path(self, kind, project):
+        return os.path.join(self.directory, hashlib.sha1('%s\0%s' % (kind, project)).hexdigest() + '.json')
+
+    def state_lock(self, kind, project):
+        """Returns the lock to hold while reading and updating the state of a build."""
+        with self.lock:
+            return self.state_locks.setdefault((kind, project), threading.Lock())
+
+    def load(self, kind, project):
+        """
+        Returns the state of the KIND of build of a PROJECT: the hashes of its input files with their size
+        and modification time, and the fingerprints and outputs of its last builds.
+        """
+        try:
+            with open(self.path(kind, project), 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'files': {}, 'builds': []}
+
+    def save(self, kind, project, state):
+        with atomic_write(self.path(kind, project), 'wt') as f:
+            json.dump(state, f)
+
+    def fingerprint(self, kind, project, inputs, extra=()):
+        """
+        Returns the SHA-1 of the KIND of build, of the INPUTS of a PROJECT, files and directories
+        relative to it, and of EXTRA strings such as the fingerprints of its dependencies.
+        Files whose size and modification time didn't change since the last call aren't read again.
+        """
+        with self.state_lock(kind, project):
+            state = self.load(kind, project)
+            known = state['files']
+            files = {}
+            digest = hashlib.sha1(kind + '\n')
+
+            for name in inputs:
+                path = os.path.join(project, name)
+                if os.path.isdir(path):
+                    paths = []
+                    for root, dirs, names in os.walk(path):
+                        dirs[:] = [d for d in dirs if not d.startswith('.')]
+                        paths += [os.path.join(root, n) for n in names if not n.startswith('.')]
+                elif os.path.isfile(path):
+                    paths = [path]
+                else:
+                    continue
+
+                for path in sorted(paths):
+                    relative = os.path.relpath(path, project)
+                    stat = os.stat(path)
+                    entry = known.get(relative)
+                    if entry is None or entry[:2] != [stat.st_size, stat.st_mtime]:
+                        entry = [stat.st_size, stat.st_mtime, file_checksum(path, 'sha1')]
+                    files[relative] = entry
+                    digest.update('%s\0%s\n' % (relative, entry[2]))
+
+            for value in extra:
+                digest.update(value + '\n')
+
+            state['files'] = files
+            self.save(kind, project, state)
+            return digest.hexdigest()
+
+    def restore(self, kind, project, fingerprint):
+        """
+        Returns True if the outputs of a KIND of build of PROJECT with the same FINGERPRINT are in place,
+        either still in the project since the last build or restored from the artifact cache.
+        """
+        with self.state_lock(kind, project):
+            state = self.load(kind, project)
+            builds = state['builds']
+            build = next((build for build in builds if build['fingerprint'] == fingerprint), None)
+            if build is None:
+                return False
+
+            latest = build is builds[-1]
+            if latest and all(os.path.exists(os.path.join(project, name)) for name in build['outputs']):
+                return True
+
+            with self.lock:
+                objects = [self.artifacts.get('build/%s/%s' % (fingerprint, name)) for name in build['outputs']]
+            if None in objects:
+                return False
+
+            # Files left by other builds would be mixed with the restored ones
+            for name in build.get('directories', []):
+                path = os.path.join(project, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+
+            for name, path in zip(build['outputs'], objects):
+                dest = os.path.join(project, name)
+                if not os.path.isdir(os.path.dirname(dest)):
+                    os.makedirs(os.path.dirname(dest))
+                shutil.copyfile(path, dest)
+
+            builds.remove(build)
+            builds.append(build)
+            self.save(kind, project, state)
+            return True
+
+    def put(self, kind, project, fingerprint, outputs):
+        """Records a successful KIND of build of PROJECT and stores the files in the OUTPUTS directories."""
+        names = []
+        for name in outputs:
+            path = os.path.join(project, name)
+            for root, dirs, files in os.walk(path):
+                names += [os.path.relpath(os.path.join(root, f), project) for f in files]
+
+        with self.lock:
+            self.artifacts.put_all([('build/%s/%s' % (fingerprint, name), os.path.join(project, name))
+                                    for name in names])
+
+        with self.state_lock(kind, project):
+            state = self.load(kind, project)
+            builds = [build for build in state['builds'] if build['fingerprint'] != fingerprint]
+            builds.append({'fingerprint': fingerprint, 'outputs': sorted(names), 'directories': list(outputs)})
+            state['builds'] = builds[-self.history:]
+            self.save(kind, project, state)
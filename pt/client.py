@@ -1,12 +1,92 @@
+import re
 import json
+import hashlib
 import urlparse
-from dns import resolver
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from commons import *
+import jsonstream
+from transfer import UploadStream, MultipartUploadStream, file_size, write_response, content_range, validator
+from tasks import TaskWatcher, TIMEOUT as TASK_TIMEOUT
+
+POOL_SIZE = 10
+RETRIES = 3
+# Seconds to wait for a connection. Responses are awaited without a timeout by default:
+# script executions, pack deployments and index rebuilds send nothing until they finish.
+CONNECT_TIMEOUT = 10
+TIMEOUT = None
+
+SERVER_TIME_SCRIPT = 'com.egis.utils.DateUtils.getISO(new Date())'
+
+
+def create_session(username, password, pool_size=POOL_SIZE, retries=RETRIES):
+    """
+    Creates a keep-alive HTTP session with a connection pool of POOL_SIZE sockets per host.
+    Idempotent requests are retried on connection errors and gateway failures.
+    """
+    session = requests.Session()
+    session.auth = (username, password)
+    session.verify = False
+    session.headers.update({'User-Agent': 'Mozilla', 'jsonErrors': 'true'})
+
+    retry = Retry(total=retries, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class PqlPageError(Exception):
+    pass
+
+
+def parse_server_time(text):
+    return dt.datetime.strptime(text, '%Y-%m-%d %H:%M:%S')
+
+
+def tree_files(local_dir, node):
+    """Returns (remote path, local path) pairs for every non-hidden file under LOCAL_DIR mapped onto NODE."""
+    files = []
+    for root, dirs, names in os.walk(local_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if name.startswith('.'):
+                continue
+            local_path = os.path.join(root, name)
+            relative = os.path.relpath(local_path, local_dir).replace(os.sep, '/')
+            files.append((node.rstrip('/') + '/' + relative, local_path))
+    return files
+
+
+# Client instances reused across commands by a long running process (see keep_clients)
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def keep_clients():
+    """Makes get_client reuse Client instances and their connection pools."""
+    global _clients
+    _clients = {}
+
+
+def get_client(url, username='admin', password=None, **kwargs):
+    """Returns a new Client, or a kept one with the same settings if keep_clients was called."""
+    if _clients is None:
+        return Client(url, username, password, **kwargs)
+
+    key = (url, username, password, tuple(sorted(kwargs.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = Client(url, username, password, **kwargs)
+        return _clients[key]
 
 
 class Client:
 
-    def __init__(self, url, username='admin', password=None):
+    def __init__(self, url, username='admin', password=None,
+                 pool_size=POOL_SIZE, retries=RETRIES, timeout=TIMEOUT):
         if password is None:
             password = os.environ.get('ADMIN_PASS')
         self.url = url.strip()
@@ -14,19 +94,84 @@ class Client:
         self.host = self.name
         self.username = username
         self.password = password
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = create_session(username, password, pool_size, retries)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request over the pooled session, following redirects the same way
+        as commons.http_get/http_post do. Returns None if the server can't be reached.
+        """
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, self.timeout))
+        try:
+            print_info(url + " ..  ")
+            r = self.session.request(method, url, allow_redirects=False, **kwargs)
+            if r.status_code > 300 and r.status_code < 400:
+                print_ok(" -> " + r.headers['Location'] + "\n")
+                return self.request(method, r.headers['Location'], **kwargs)
+            print_response(r)
+            return r
+        except requests.exceptions.ConnectionError:
+            print_fail(" connection refused \n")
+        except requests.exceptions.RequestException, e:
+            print_fail(str(e))
 
     def post(self, url, data, headers={}, **kwargs):
-        return http_post(self.url + "/" + url, data=data, headers=headers,
-                         username=self.username, password=self.password, **kwargs)
+        return self.request('POST', self.url + "/" + url, data=data, headers=headers, **kwargs)
 
     def get(self, url, params=None, **kwargs):
-        return http_get(self.url + "/" + url, username=self.username, password=self.password, params=params, **kwargs)
+        return self.request('GET', self.url + "/" + url, params=params, **kwargs)
 
-    def pql_query(self, query):
-        response = self.get('document/pql', { 'query': query, 'includeMetadata': True })
+    def close(self):
+        self.session.close()
+
+    def pql_query(self, query, stream=False):
+        """
+        Executes a PQL query. With STREAM the result 'items' are decoded incrementally
+        from the response body and returned as a generator.
+        """
+        response = self.get('document/pql', { 'query': query, 'includeMetadata': True }, stream=stream)
         if response and response.status_code == 200:
+            if stream:
+                return jsonstream.load_response(response, 'items', require=('metadata',))
             return response.json()
 
+    def pql_pages(self, query, page_size, stream=False):
+        """
+        Yields successive pages of a PQL query result, fetching PAGE_SIZE rows at a time
+        with LIMIT/OFFSET so only one page is held in memory.
+        The items of each page must be consumed before requesting the next one.
+
+        The QUERY can't have its own LIMIT or OFFSET, and the pages are only consistent
+        if it has an ORDER BY on a unique column. Raises PqlPageError if a page fails,
+        rather than ending a truncated result.
+        """
+        query = query.strip().rstrip(';').strip()
+        if re.search(r'\b(LIMIT|OFFSET)\s+\d+\s*$', query, re.IGNORECASE):
+            raise PqlPageError('The query already has a LIMIT or OFFSET, run it without paging')
+
+        offset = 0
+        while True:
+            page = self.pql_query('%s LIMIT %d OFFSET %d' % (query, page_size, offset), stream)
+            if page is None:
+                raise PqlPageError('Fetching the rows from %d failed, the result is incomplete' % offset)
+
+            fetched = [0]
+
+            def count(items):
+                for row in items:
+                    fetched[0] += 1
+                    yield row
+
+            if 'items' in page:
+                page['items'] = count(page['items'])
+
+            yield page
+            if fetched[0] < page_size:
+                return
+            offset += page_size
+
     def task_list(self, options):
         tasks = json.loads(self.get('tasks'))
         for item in tasks["items"]:
@@ -35,12 +180,13 @@ class Client:
 
     def ping(self, port=443):
         host = urlparse.urlparse(self.url).netloc.split(":")[0]
+        from dns import resolver
         records = resolver.query(host, 'A')
         if len(records) is 0:
             return False
         return ping(records[0].address, port)
 
-    def db_backup(self):
+    def db_backup(self, timeout=TASK_TIMEOUT):
         start = Timer()
         now = self.server_time()
         print(now)
@@ -51,8 +197,11 @@ class Client:
             minute = 0
 
         self.update_properties({'db.backup.schedule': '%s %s * * *' % (minute, hour)})
-        wait(self.db_has_current_backup, 10)
+        if TaskWatcher(self, now, timeout=timeout).wait('DB Backup', now) is None:
+            print_fail("db backup did not complete in %s seconds" % timeout)
+            return False
         print("db backed up in " + str(start))
+        return True
 
     def get_s3_backup(self,access, secret, bucket, license=None):
         print_info(" Getting last S3 backup ..")
@@ -67,11 +216,16 @@ class Client:
                 max = key
         return max
 
-    def fs_backup(self):
+    def fs_backup(self, timeout=TASK_TIMEOUT):
         start = Timer()
+        watcher = TaskWatcher(self, timeout=timeout)
+        now = watcher.server_time()
         self.fs_sync()
-        wait(self.fs_has_current_backup, 10)
+        if watcher.wait('Storage process', now) is None:
+            print_fail("fs backup did not complete in %s seconds" % timeout)
+            return False
         print("fs backed up in " + str(start))
+        return True
 
     def db_backup_age(self):
         start = self.db_last_backup_time()
@@ -99,10 +253,10 @@ class Client:
 
     def get_backup_config(self):
         try:
-            r = self.get('dao/listFull/FileStore')
+            r = self.get('dao/listFull/FileStore', stream=True)
             if r is None:
                 return (None,None,None)
-            stores = r.json()
+            stores = jsonstream.load_response(r, 'items', require=('totalCount',))
             if "totalCount" not in stores:
                 return (None,None,None)
             if (stores['totalCount'] == 0):
@@ -214,7 +368,14 @@ class Client:
         if response.status_code == 200:
             return response.json()
 
-    def update_document(self, path, contents):
+    def update_document(self, path, contents, progress=False):
+        """
+        Uploads CONTENTS, a string or a file object, to the document at PATH.
+        Files are streamed in chunks, optionally reporting the PROGRESS.
+        Pipes are passed as they are and sent with a chunked transfer encoding.
+        """
+        if hasattr(contents, 'fileno') and file_size(contents) > 0:
+            contents = UploadStream([contents], progress)
         return self.post('public/file/{}'.format(path), data=contents,
                          headers={ 'Content-Type': 'application/octet-stream' })
 
@@ -226,12 +387,147 @@ class Client:
 
         return result
 
-    def deploy_package(self, filename, file_obj):
+    def upload_files(self, files, parallel=4):
+        """
+        Uploads FILES, a list of (remote path, local path) pairs, on PARALLEL threads sharing the connection pool.
+        Returns a list of (remote path, status code or None, error) tuples in the order of FILES.
+        """
+        def upload(args):
+            path, local_path = args
+            try:
+                with open(local_path, 'rb') as f:
+                    result = self.update_document(path, f)
+                if result is None:
+                    return path, None, 'no response'
+                if not 200 <= result.status_code < 300:
+                    return path, result.status_code, result.text
+                return path, result.status_code, None
+            except Exception, e:
+                return path, None, str(e)
+
+        pool = ThreadPool(parallel)
+        try:
+            return pool.map(upload, files)
+        finally:
+            pool.close()
+            pool.join()
+
+    def upload_tree(self, local_dir, node, parallel=4, redeploy=True):
+        """
+        Uploads every file under LOCAL_DIR to the matching path under the remote NODE
+        and redeploys workflows once at the end.
+        """
+        results = self.upload_files(tree_files(local_dir, node), parallel)
+
+        if redeploy and any(error is None for path, status, error in results):
+            self.redeploy_workflow()
+
+        return results
+
+    def download(self, url, dest_file, resume=True, progress=False):
+        """
+        Streams a remote URL to DEST_FILE. The data goes to DEST_FILE.part first,
+        so an interrupted download is resumed with a Range request on the next call.
+        The ETag or Last-Modified date of the response is kept in DEST_FILE.part.validator
+        and sent as If-Range, so the server sends the whole file again if it changed since.
+        Returns True if the file was downloaded.
+        """
+        part_file = dest_file + '.part'
+        validator_file = part_file + '.validator'
+
+        offset = 0
+        headers = {}
+        if resume and os.path.exists(part_file) and os.path.exists(validator_file):
+            with open(validator_file, 'rt') as f:
+                headers['If-Range'] = f.read()
+            offset = os.path.getsize(part_file)
+            headers['Range'] = 'bytes=%d-' % offset
+
+        response = self.get(url, stream=True, headers=headers)
+        if response is None:
+            return False
+
+        start, total = content_range(response)
+        if response.status_code == 416 and total == offset:
+            # The partial file is already complete
+            response.close()
+        elif response.status_code == 206 and start == offset:
+            with open(part_file, 'ab') as f:
+                write_response(response, f, offset, progress)
+        elif response.status_code == 200:
+            # The file changed or the server ignored the Range header
+            value = validator(response)
+            if value:
+                with open(validator_file, 'wt') as f:
+                    f.write(value)
+            elif os.path.exists(validator_file):
+                os.remove(validator_file)
+            with open(part_file, 'wb') as f:
+                write_response(response, f, 0, progress)
+        else:
+            response.close()
+            # The partial file doesn't match the remote one, the next attempt starts over
+            if response.status_code in (206, 416) and os.path.exists(validator_file):
+                os.remove(validator_file)
+            return False
+
+        if os.path.exists(dest_file):
+            os.remove(dest_file)
+        os.rename(part_file, dest_file)
+        if os.path.exists(validator_file):
+            os.remove(validator_file)
+        return True
+
+    def download_documents(self, paths, out_dir, parallel=4, retries=3):
+        """
+        Downloads the documents at PATHS into OUT_DIR on PARALLEL threads, keeping the remote
+        node structure. Failed downloads are resumed up to RETRIES times.
+        Yields (path, local file, error) tuples as the downloads complete.
+        """
+        def fetch(path):
+            dest_file = os.path.join(out_dir, *path.strip('/').split('/'))
+            directory = os.path.dirname(dest_file)
+            error = None
+
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(attempt)
+                try:
+                    if not os.path.isdir(directory):
+                        os.makedirs(directory)
+                    if self.download('public/file/{0}/{1}'.format(path, path.split('/')[-1]), dest_file):
+                        return path, dest_file, None
+                    error = 'download failed'
+                except Exception, e:
+                    error = str(e)
+
+            return path, dest_file, error
+
+        pool = ThreadPool(parallel)
+        try:
+            for result in pool.imap_unordered(fetch, paths):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def document_hash(self, path):
+        """Returns the SHA-1 of a remote document content or None if it can't be downloaded."""
+        response = self.get('public/file/{0}/{1}'.format(path, path.split('/')[-1]), stream=True)
+        if response is None or response.status_code != 200:
+            return None
+
+        digest = hashlib.sha1()
+        for chunk in response.iter_content(64 * 1024):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def deploy_package(self, filename, file_obj, progress=False):
         """
-        Deploys a binary archive package.
+        Deploys a binary archive package, streaming it from FILE_OBJ as a multipart upload.
         """
-        file_description = (filename, file_obj, 'application/octet-stream')
-        return self.post('action/execute/deploy_pack', {}, files={'file': file_description})
+        body = MultipartUploadStream('file', filename, file_obj, progress=progress)
+        return self.post('action/execute/deploy_pack', body, headers={'Content-Type': body.content_type})
 
     def redeploy_workflow(self):
         return self.post('workflow/redeploy', {},
@@ -281,7 +577,7 @@ class Client:
         self.post("action/execute/index_repair", {"cmd": "save"})
 
     def server_time(self):
-        return dt.datetime.strptime(self.execute('com.egis.utils.DateUtils.getISO(new Date())'), '%Y-%m-%d %H:%M:%S')
+        return parse_server_time(self.execute(SERVER_TIME_SCRIPT))
 
     def get_store(self, name):
         stores = self.get('dao/listFull/FileStore').json()
@@ -1,4 +1,3 @@
-
 import sys
 import pkgutil
 import importlib
@@ -6,19 +5,55 @@ import importlib
 import click
 from commons import *
 
-def init_plugins(group):
-    """Imports extra commands from modules to a provided click command group."""
+def plugin_names():
+    """Lists the plugin modules of this package without importing them."""
+    package = sys.modules[__name__]
+    return [module_name for (importer, module_name, ispkg) in pkgutil.iter_modules(package.__path__) if not ispkg]
+
+def load_plugin(module_name):
+    """Imports a plugin module and returns its "run" command or None if it can't be loaded."""
     package = sys.modules[__name__]
 
-    for (importer, module_name, ispkg) in pkgutil.iter_modules(package.__path__):
-        if not ispkg:
-            try:
-                module = importlib.import_module(package.__name__ + '.' + module_name)
-
-                if 'run' not in module.__dict__:
-                    print_fail('Plugin command "%s" doesn\'t provide a "run" method. Aborting.' % (module_name))
-                    # sys.exit(-1)
-                else:
-                    group.add_command(module.run)
-            except Exception, e:
-                print_fail('[%s] %s' % (module_name, str(e) + str(type(e))))
+    try:
+        module = importlib.import_module(package.__name__ + '.' + module_name)
+
+        if 'run' not in module.__dict__:
+            print_fail('Plugin command "%s" doesn\'t provide a "run" method. Aborting.' % (module_name))
+            # sys.exit(-1)
+        else:
+            return module.run
+    except Exception, e:
+        print_fail('[%s] %s' % (module_name, str(e) + str(type(e))))
+
+
+class LazyGroup(click.Group):
+    """
+    A command group which imports plugin modules only when their command is invoked
+    (or the help is printed). A plugin command is registered under its module name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.plugins = []
+
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) | set(self.plugins))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.plugins:
+            command = load_plugin(name)
+            if command is not None:
+                self.add_command(command, name)
+        return super(LazyGroup, self).get_command(ctx, name)
+
+
+def init_plugins(group):
+    """Adds extra commands from modules to a provided click command group."""
+    if isinstance(group, LazyGroup):
+        group.plugins.extend(plugin_names())
+        return
+
+    for module_name in plugin_names():
+        command = load_plugin(module_name)
+        if command is not None:
+            group.add_command(command)
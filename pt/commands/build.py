@@ -6,8 +6,11 @@ import sys
 from os.path import basename
 import os
 import os.path
-import datetime
+import re
 import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 if os.name == 'nt':
     # Build command is not supported on Windows
@@ -19,8 +22,13 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from termcolor import colored, cprint
 
+from pt.cache import BuildCache
+from pt.sync import sync_files, sync_tree
+
 
 quick = True
+# Seconds without file changes before the changes of a project are built
+QUIET_PERIOD = 0.5
 gradle = sh.Command("gradle")
 ant = sh.Command("ant")
 npm = sh.Command("npm")
@@ -31,6 +39,13 @@ def notify(msg):
 
 
 class Builder(FileSystemEventHandler):
+    # The file declaring the project build, see depends_on
+    build_file = None
+    # Files and directories the full build depends on and produces, see BuildCache.
+    # Builders without inputs are always built.
+    inputs = None
+    outputs = []
+
     def __init__(self, path, observer, watch):
         self.project = path
         self.path = path
@@ -39,40 +54,123 @@ class Builder(FileSystemEventHandler):
         self.cmdp = None
         self.observer = observer
 
+        # Changed paths waiting for the quiet period to be built together
+        self.changes = set()
+        self.first_change = None
+        self.last_change = None
+        self.condition = threading.Condition()
+        self.worker = None
+        # The running build command and whether new changes superseded it
+        self.running = None
+        self.superseded = False
+
         def out(line):
             sys.stdout.write(colored(self.project, 'blue') + " " + line)
         self.out = out
 
+        # Full builds are run by build_all
         if watch:
             cprint('\nWatching ' + type(self).__name__ + " " + path, 'cyan')
             self.watch()
-        else:
-            cprint('\nBuilding ' + type(self).__name__ + " " + path, 'cyan')
-            self.full()
 
-    def build(self, path):
+    def run_cmd(self, cmd, *args):
+        """Runs a build command in the background, so it can be cancelled, and waits for it."""
+        self.running = cmd(*args, _out=self.out, _cwd=self.cwd, _bg=True, _bg_exc=False)
+        try:
+            self.running.wait()
+        finally:
+            self.running = None
+
+    def build(self, paths):
         if self.cmd is not None:
-            self.cmd(_out=self.out, _cwd=self.cwd)
+            self.run_cmd(self.cmd)
         if self.cmdp is not None:
-            self.cmdp(path, _out=self.out, _cwd=self.cwd)
+            for path in paths:
+                self.run_cmd(self.cmdp, path)
+
+    def stop(self):
+        """Stops the running build when pt build exits."""
+        self.cancel()
+
+    def cancel(self):
+        """Stops the running build, its changes are built again with the new ones."""
+        running = self.running
+        if running is not None:
+            self.superseded = True
+            try:
+                running.process.terminate()
+            except OSError:
+                pass
 
     def on_any_event(self, event):
         path = event.src_path
         if event.event_type == "deleted" or not os.path.isfile(path):
             return
-        print(event.event_type + " " + path)
-        start = datetime.datetime.now().replace(microsecond=0)
-        try:
-            self.build(path)
-            cprint("Completed in %s " %
-                   (datetime.datetime.now().replace(microsecond=0) - start), 'green')
-        except Exception, e:
-            cprint(e.stderr, 'red')
-            print(notify(e.stderr))
+
+        with self.condition:
+            now = time.time()
+            if not self.changes:
+                self.first_change = now
+            self.changes.add(path)
+            self.last_change = now
+            self.cancel()
+            self.condition.notify()
+
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.build_changes)
+                self.worker.daemon = True
+                self.worker.start()
+
+    def next_changes(self):
+        """Waits for changes followed by QUIET_PERIOD seconds without changes and returns them."""
+        with self.condition:
+            while not self.changes:
+                self.condition.wait()
+            while True:
+                remaining = self.last_change + QUIET_PERIOD - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            changes, first_change = sorted(self.changes), self.first_change
+            self.changes = set()
+            self.superseded = False
+            return changes, first_change
+
+    def build_changes(self):
+        """Builds the changes of the project, one burst of changes at a time."""
+        while True:
+            paths, first_change = self.next_changes()
+            for path in paths[:10]:
+                self.out("changed %s\n" % path)
+            if len(paths) > 10:
+                self.out("... and %d more\n" % (len(paths) - 10))
+
+            start = time.time()
+            try:
+                self.build(paths)
+                end = time.time()
+                cprint("Built %d changes in %.1fs, %.1fs after the first change" %
+                       (len(paths), end - start, end - first_change), 'green')
+            except Exception, e:
+                if self.superseded:
+                    with self.condition:
+                        # Rebuild these changes with the new ones
+                        self.changes.update(paths)
+                        self.first_change = first_change
+                    cprint("Build of %s superseded by new changes" % self.project, 'yellow')
+                    continue
+                error = getattr(e, 'stderr', None) or str(e)
+                cprint(error, 'red')
+                notify(error)
 
 class Gulp(Builder):
+    build_file = "package.json"
+    inputs = ["src", "package.json", "gulpfile.js"]
+    outputs = ["dist"]
+
     def full(self):
-        npm("run", "build", _cwd=self.cwd, _bg=True, _out=self.out)
+        npm("run", "build", _cwd=self.cwd, _out=self.out)
         return self
 
     def watch(self):
@@ -81,9 +179,15 @@ class Gulp(Builder):
 
 
 class Java(Builder):
+    inputs = ["api", "src", "test"]
+
     def __init__(self, path, observer, watch):
         super(Java, self).__init__(path, observer, watch)
 
+        # Builders without a command watch the sources themselves
+        if self.cmd is None:
+            return
+
         if os.path.isdir(path + "/api"):
             observer.schedule(self, path + "/api", recursive=True)
         if os.path.isdir(path + "/src"):
@@ -96,14 +200,47 @@ class Java(Builder):
 
 
 class Gradle(Java):
+    """
+    Builds in the Gradle daemon, which keeps the JVM and the build configuration warm.
+    When watching with CONTINUOUS, a single continuous build watches the sources and
+    recompiles incrementally instead of running Gradle for each change.
+    """
+
+    build_file = "build.gradle"
+    inputs = Java.inputs + ["build.gradle", "settings.gradle", "gradle.properties"]
+    outputs = ["build/libs"]
+
+    def __init__(self, path, observer, watch, continuous=True):
+        self.continuous = continuous
+        self.continuous_build = None
+        super(Gradle, self).__init__(path, observer, watch)
+
     def watch(self):
-        self.cmd = gradle.bake("classes", "apiClasses", "testClasses", "--info")
+        if self.continuous:
+            self.continuous_build = gradle("--continuous", "--daemon", "classes", "apiClasses", "testClasses",
+                                           _out=self.out, _err=self.out, _cwd=self.cwd, _bg=True, _bg_exc=False)
+        else:
+            self.cmd = gradle.bake("--daemon", "classes", "apiClasses", "testClasses", "--info")
 
     def full(self):
-        gradle("jar", _out=self.out, _cwd=self.cwd)
+        gradle("--daemon", "jar", _out=self.out, _cwd=self.cwd)
+
+    def stop(self):
+        super(Gradle, self).stop()
+        if self.continuous_build is not None:
+            try:
+                self.continuous_build.process.terminate()
+                self.continuous_build.wait()
+            except Exception:
+                # The terminated build raises a signal exception
+                pass
 
 
 class Ant(Java):
+    build_file = "build.xml"
+    inputs = Java.inputs + ["build.xml"]
+    outputs = ["dist"]
+
     def watch(self):
         self.cmd = ant.bake("compile")
 
@@ -113,61 +250,218 @@ class Ant(Java):
 
 
 class PaperTrail(Builder):
+    """
+    Uploads the changed scripts to the server, concurrently over the client connection
+    pool, and redeploys the workflows once per batch of changes.
+    """
+
+    node = "System/scripts"
+
     def __init__(self, client, path, observer, watch):
-        super(PaperTrail, self).__init__(path, observer, watch)
         self.client = client
+        self.scripts = path + "/" + self.node
+        super(PaperTrail, self).__init__(path, observer, watch)
+
+    def upload(self, results):
+        failed = [(path, status, error) for path, status, error in results if error is not None]
+        for path, status, error in results:
+            if error is None:
+                self.out("uploaded %s\n" % path)
+        if failed:
+            raise Exception("\n".join("%s: %s %s" % (path, status or '', error) for path, status, error in failed))
 
-    def build(self, path):
-        print(path)
-        with open(path, 'rt') as script:
-            self.client.upload_script(basename(path), script.read())
+    def build(self, paths):
+        files = [(self.node + "/" + os.path.relpath(path, self.scripts).replace(os.sep, '/'), path)
+                 for path in paths]
+        self.upload(sync_files(self.client, files, self.client.pool_size, redeploy=True))
 
     def watch(self):
-        path = self.path + "/System/scripts"
-        if os.path.isdir(path):
-            self.out("Watching %s" % path)
-            self.observer.schedule(self, path, recursive=True)
+        if os.path.isdir(self.scripts):
+            try:
+                self.full()
+            except Exception, e:
+                cprint(str(e), 'red')
+            self.out("Watching %s\n" % self.scripts)
+            self.observer.schedule(self, self.scripts, recursive=True)
 
     def full(self):
-        if os.path.isdir(self.path + "/System/scripts"):
-            for p in os.listdir(self.path + "/System/scripts"):
-                self.cmd(p, _cwd=self.cwd)
+        """Uploads the scripts which differ from the server documents."""
+        if os.path.isdir(self.scripts):
+            self.upload(sync_tree(self.client, self.scripts, self.node, self.client.pool_size, remote=True))
+
+
+def depends_on(builder, builders):
+    """
+    Returns the BUILDERS of other projects which the build file of BUILDER refers to,
+    as a relative path (../name/ or "../name") or a Gradle project (project(':name') or include ':name').
+    Maven coordinates such as 'group:name:1.0' aren't references to a project.
+    """
+    if builder.build_file is None:
+        return []
+    with open(os.path.join(builder.path, builder.build_file), 'rt') as f:
+        text = f.read()
+
+    dependencies = []
+    for other in builders:
+        if other.path == builder.path or other.build_file is None:
+            continue
+        name = re.escape(basename(other.path))
+        patterns = [r'\.\./%s[/\'"]' % name,
+                    r'project\(\s*[\'"]:%s[\'"]' % name,
+                    r'^\s*include\b.*[\'"]:?%s[\'"]' % name]
+        if any(re.search(pattern, text, re.M) for pattern in patterns):
+            dependencies.append(other)
+    return dependencies
+
+
+def build_all(builders, parallel, ordered=True, cache=None, rebuild=False):
+    """
+    Runs the full builds of BUILDERS, up to PARALLEL at once. With ORDERED a project
+    is built after the projects it depends on, and skipped if one of them failed.
+    With a CACHE, projects whose inputs and dependencies are unchanged aren't built
+    again and their outputs are restored if needed, unless REBUILD is set.
+    Returns the (builder, status, seconds) results in the order the builds finished.
+    """
+    dependencies = dict((builder, depends_on(builder, builders) if ordered else []) for builder in builders)
+    pending = list(builders)
+    running = set()
+    results = []
+    statuses = {}
+    fingerprints = {}
+    condition = threading.Condition()
+
+    def build(builder):
+        start = time.time()
+        status = 'ok'
+        kind = type(builder).__name__
+        try:
+            fingerprint = None
+            if cache is not None and builder.inputs is not None:
+                with condition:
+                    extra = [fingerprints[dep] for dep in dependencies[builder] if dep in fingerprints]
+                fingerprint = cache.fingerprint(kind, builder.path, builder.inputs, extra)
+
+            if fingerprint is not None and not rebuild and cache.restore(kind, builder.path, fingerprint):
+                status = 'cached'
+            else:
+                cprint('\nBuilding ' + kind + " " + builder.path, 'cyan')
+                builder.full()
+                if fingerprint is not None:
+                    cache.put(kind, builder.path, fingerprint, builder.outputs)
+
+            if fingerprint is not None:
+                with condition:
+                    fingerprints[builder] = fingerprint
+        except Exception, e:
+            status = 'failed'
+            cprint("%s: %s" % (builder.project, getattr(e, 'stderr', None) or e), 'red')
+        with condition:
+            running.remove(builder)
+            statuses[builder] = status
+            results.append((builder, status, time.time() - start))
+            condition.notify()
+
+    pool = ThreadPool(parallel)
+    try:
+        with condition:
+            while pending or running:
+                skipped = True
+                while skipped:
+                    skipped = [builder for builder in pending
+                               if any(statuses.get(dep) in ('failed', 'skipped') for dep in dependencies[builder])]
+                    for builder in skipped:
+                        pending.remove(builder)
+                        statuses[builder] = 'skipped'
+                        results.append((builder, 'skipped', 0))
+
+                for builder in list(pending):
+                    if all(dep in statuses for dep in dependencies[builder]) and len(running) < parallel:
+                        pending.remove(builder)
+                        running.add(builder)
+                        pool.apply_async(build, (builder,))
+
+                if pending and not running:
+                    # Every remaining project waits for another one, follow them to a cycle
+                    builder, visited = pending[0], []
+                    while builder not in visited:
+                        visited.append(builder)
+                        builder = [dep for dep in dependencies[builder] if dep in pending][0]
+                    cprint('Dependency cycle at %s, building it first' % builder.project, 'yellow')
+                    dependencies[builder] = []
+                    continue
+                if pending or running:
+                    condition.wait(1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def print_build_summary(results, elapsed):
+    width = max(len(builder.project) for builder, status, seconds in results)
+    colors = {'ok': 'green', 'cached': 'cyan', 'failed': 'red', 'skipped': 'yellow'}
+    print("")
+    for builder, status, seconds in sorted(results, key=lambda result: -result[2]):
+        cprint("%s %-10s %-8s %6.1fs" % (builder.project.ljust(width), type(builder).__name__, status, seconds),
+               colors[status])
+    cprint("%d projects built in %.1fs" % (len(results), elapsed), 'cyan')
 
 
 @click.command('build')
 @click.option('--watch', '-w', is_flag=True, default=False)
+@click.option('--continuous/--no-continuous', default=True,
+              help='Watch Gradle projects with a Gradle continuous build instead of running Gradle for each change')
+@click.option('--parallel', '-j', default=multiprocessing.cpu_count(), help='Number of projects to build at once')
+@click.option('--ordered/--unordered', default=True,
+              help='Build projects after the projects their build files refer to')
+@click.option('--force', '-f', is_flag=True, default=False,
+              help='Build the projects whose inputs are unchanged since their last build')
 @click.argument('dirs', nargs=-1, required=False)
 @click.pass_obj
-def run(client, watch, dirs):
+def run(client, watch, continuous, parallel, ordered, force, dirs):
     """
     Provides development tools.
 
-    Watches the source code directory for changes and automatically rebuilds the project.
+    Builds the projects in DIRS concurrently, or with --watch, watches the
+    source code directories for changes and automatically rebuilds the projects.
     """
     observer = Observer()
+    builders = []
 
-    if not dirs:
-        dirs = os.listdir('.')
+    dirs = list(dirs or os.listdir('.'))
 
     dirs.append(os.getcwd())
+    seen = set()
     for path in dirs:
         if not os.path.isdir(path):
             continue
 
         path = os.path.realpath(path)
+        if path in seen:
+            continue
+        seen.add(path)
 
         for p in ["/resources", "/configs"]:
             if os.path.isdir(path + p):
-                builder = PaperTrail(client, path + p, observer, watch)
+                builders.append(PaperTrail(client, path + p, observer, watch))
 
         if os.path.isfile(path + "/package.json"):
-            builder = Gulp(path, observer, watch)
+            builders.append(Gulp(path, observer, watch))
 
         if os.path.isfile(path + "/build.xml"):
-            builder = Ant(path, observer, watch)
+            builders.append(Ant(path, observer, watch))
         elif os.path.isfile(path + "/build.gradle"):
-            builder = Gradle(path, observer, watch)
+            builders.append(Gradle(path, observer, watch, continuous))
 
+    if not watch:
+        start = time.time()
+        results = build_all(builders, max(1, parallel), ordered, BuildCache(), force)
+        if results:
+            print_build_summary(results, time.time() - start)
+        if any(status in ('failed', 'skipped') for builder, status, seconds in results):
+            sys.exit(1)
+        return
 
     observer.start()
     notify("Started")
@@ -178,4 +472,6 @@ def run(client, watch, dirs):
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
+        for builder in builders:
+            builder.stop()
     observer.join()
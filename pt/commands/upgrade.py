@@ -13,7 +13,8 @@ INSTALLER_OUTPUT = '/opt/Papertrail.sh' if os.name == 'posix' else os.getenv('AP
 @click.argument('version', required=False)
 @click.option('--norestart', is_flag=True, help="Turn off auto restart of a Papertrail instance after the update")
 @click.option('--output', '-o', default=INSTALLER_OUTPUT, help="Destination file for the upgrade package")
-def run(version, norestart, output):
+@click.option('--no-cache', is_flag=True, help="Download the package even if it's in the local artifact cache")
+def run(version, norestart, output, no_cache):
     """
     Upgrades a local Papertrail installation to the latest available version.
 
@@ -32,7 +33,7 @@ def run(version, norestart, output):
 
     # Download the build
     click.echo('Downloading version %s' % (build))
-    ver.download(build, output)
+    ver.download(build, output, cache=not no_cache)
 
     # Unpack and install the downloaded package
     click.echo('Upgrading')
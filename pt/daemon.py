@@ -0,0 +1,331 @@
+"""
+A persistent pt process keeping warm clients and connection pools.
+
+The daemon listens on a Unix socket and runs the forwarded commands in threads,
+streaming their output back. The pt entry point (main) forwards the commands
+listed in FORWARDED_COMMANDS to it when it's running, falling back to running
+them locally otherwise.
+
+This module is imported on every pt invocation, so it only uses light standard
+library modules at the top level.
+"""
+
+import os
+import sys
+import json
+import errno
+import socket
+import struct
+import threading
+import importlib
+
+PT_DIR = os.path.join(os.path.expanduser('~'), '.pt')
+SOCKET_PATH = os.getenv('PT_DAEMON_SOCKET', os.path.join(PT_DIR, 'daemon.sock'))
+PID_FILE = os.path.join(PT_DIR, 'daemon.pid')
+LOG_FILE = os.path.join(PT_DIR, 'daemon.log')
+
+# Commands which don't read local files or the standard input
+FORWARDED_COMMANDS = ['get', 'pql', 'eval', 'info', 'sessions', 'tasks', 'logs', 'export', 'new_token',
+                      'redeploy', 'get_backup_config']
+
+# Global options and the environment variables they are read from
+GLOBAL_OPTIONS = [('--host', ['PT_API']),
+                  ('--username', ['PT_USER', 'PT_API_USER']),
+                  ('--password', ['PT_PASS', 'PT_API_PASS']),
+                  ('--pool-size', ['PT_POOL_SIZE']),
+                  ('--retries', ['PT_RETRIES']),
+                  ('--timeout', ['PT_TIMEOUT'])]
+
+# Frame types: a frame is a type byte, a 4 byte length and the payload
+STDOUT = b'1'
+STDERR = b'2'
+EXIT = b'x'
+REFUSED = b'r'
+HEADER = struct.Struct('>cI')
+
+
+def command_name(argv):
+    """Returns the command name from pt arguments, skipping the global options."""
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith('-'):
+            return arg
+        i += 1 if '=' in arg or arg == '--help' else 2
+
+
+def env_options():
+    """Converts the environment variables read by the global options to explicit arguments."""
+    args = []
+    for option, names in GLOBAL_OPTIONS:
+        for name in names:
+            if name in os.environ:
+                args += [option, os.environ[name]]
+                break
+    return args
+
+
+def read_frame(f):
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None, None
+    kind, length = HEADER.unpack(header)
+    return kind, f.read(length)
+
+
+def forward(argv):
+    """
+    Runs a pt command in the daemon, if it's running and accepts the command.
+    Returns the command exit code or None if the command should be run locally.
+    """
+    if command_name(argv) not in FORWARDED_COMMANDS:
+        return None
+    # Site configs are resolved relative to the working directory
+    if os.getenv('PT_SITE') or any(arg.startswith('--site') for arg in argv):
+        return None
+    if not os.path.exists(SOCKET_PATH):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.sendall(json.dumps({'argv': env_options() + list(argv)}).encode('utf-8') + b'\n')
+        f = sock.makefile('rb')
+
+        while True:
+            kind, payload = read_frame(f)
+            if kind is None:
+                # The daemon went away, the output is incomplete
+                return 1
+            if kind == REFUSED:
+                return None
+            if kind == EXIT:
+                return int(payload)
+
+            out = sys.stdout if kind == STDOUT else sys.stderr
+            out.write(payload)
+            out.flush()
+    finally:
+        sock.close()
+
+
+def main():
+    """The pt entry point."""
+    if os.name == 'posix' and not os.getenv('PT_NO_DAEMON'):
+        code = forward(sys.argv[1:])
+        if code is not None:
+            sys.exit(code)
+
+    importlib.import_module('pt.pt').main()
+
+
+class FrameWriter:
+    """
+    A file-like object sending everything written to it as frames of a KIND.
+    It has the attributes binary writers such as pyarrow check on their sink.
+    """
+
+    closed = False
+
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.encoding = 'utf-8'
+        self.position = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            self.sock.sendall(HEADER.pack(self.kind, len(data)) + data)
+            self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ThreadOutput:
+    """Redirects sys.stdout/sys.stderr writes to a per-thread target."""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'target', None) or self.default
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    def write(self, data):
+        self.target().write(data)
+
+    def flush(self):
+        self.target().flush()
+
+
+def forwardable(name, params):
+    """Refuses the commands which would be interactive or write local files."""
+    if name == 'pql':
+        return params.get('query') is not None and params.get('batch') is None
+    return name in FORWARDED_COMMANDS
+
+
+def serve():
+    """Runs the daemon until it's terminated."""
+    import signal
+    import traceback
+    import SocketServer
+    import click
+
+    pt = importlib.import_module('pt.pt')
+    client = importlib.import_module('pt.client')
+    client.keep_clients()
+
+    stdout = sys.stdout = ThreadOutput(sys.stdout)
+    stderr = sys.stderr = ThreadOutput(sys.stderr)
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            argv = json.loads(self.rfile.readline())['argv']
+
+            # Parse the arguments without running anything to check the command can be forwarded
+            try:
+                ctx = pt.papertrail.make_context('pt', list(argv), resilient_parsing=True)
+                name = ctx.protected_args[0] if ctx.protected_args else None
+                command = pt.papertrail.get_command(ctx, name) if name else None
+                params = command.make_context(name, list(ctx.args), parent=ctx, resilient_parsing=True).params
+                accepted = forwardable(name, params)
+            except Exception:
+                accepted = False
+
+            if not accepted:
+                self.wfile.write(HEADER.pack(REFUSED, 0))
+                return
+
+            stdout.local.target = FrameWriter(self.connection, STDOUT)
+            stderr.local.target = FrameWriter(self.connection, STDERR)
+            code = 0
+            try:
+                pt.papertrail.main(args=list(argv), prog_name='pt', standalone_mode=False)
+            except click.ClickException, e:
+                e.show()
+                code = e.exit_code
+            except click.Abort:
+                code = 1
+            except SystemExit, e:
+                code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                stdout.local.target = None
+                stderr.local.target = None
+
+            self.connection.sendall(HEADER.pack(EXIT, len(str(code))) + str(code))
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    for path in [SOCKET_PATH, PID_FILE]:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    server = Server(SOCKET_PATH, Handler)
+    os.chmod(SOCKET_PATH, 0600)
+
+    with open(PID_FILE, 'w') as f:
+        f.write(str(os.getpid()))
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for path in [SOCKET_PATH, PID_FILE]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def get_pid():
+    """Returns the PID of the running daemon or None."""
+    if not os.path.exists(PID_FILE):
+        return None
+    with open(PID_FILE) as f:
+        pid = int(f.read())
+    try:
+        os.kill(pid, 0)
+        return pid
+    except OSError:
+        return None
+
+
+def start():
+    """Starts the daemon in the background. Returns its PID."""
+    import time
+    import subprocess
+
+    if not os.path.isdir(PT_DIR):
+        os.makedirs(PT_DIR)
+
+    proc = subprocess.Popen([sys.executable, '-c', 'from pt.daemon import serve; serve()'],
+                            stdout=open(LOG_FILE, 'a'), stderr=subprocess.STDOUT,
+                            stdin=open(os.devnull), close_fds=True, preexec_fn=os.setsid)
+
+    # Wait for the socket
+    for i in range(100):
+        if proc.poll() is not None:
+            return None
+        if os.path.exists(SOCKET_PATH):
+            return proc.pid
+        time.sleep(0.1)
+
+
+def stop():
+    """Stops the running daemon. Returns False if it wasn't running."""
+    import time
+
+    pid = get_pid()
+    if pid is None:
+        return False
+
+    os.kill(pid, 15)
+    while True:
+        try:
+            os.kill(pid, 0)
+            time.sleep(0.1)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return True
+            raise
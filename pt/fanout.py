@@ -0,0 +1,145 @@
+"""
+Runs a pt command against several sites concurrently.
+"""
+
+import sys
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import click
+
+from commands import LazyGroup
+from daemon import ThreadOutput
+from utils import bgcolors, print_fail_line
+from commons import *
+
+
+def read_sites(sites, sites_file):
+    """
+    Returns the site entries from a comma separated SITES list and a SITES_FILE with one entry per line.
+    An entry is either a site config name or a host URL.
+    """
+    entries = []
+    if sites:
+        entries += [site.strip() for site in sites.split(',') if site.strip()]
+    if sites_file:
+        with open(sites_file, 'rt') as f:
+            entries += [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    return entries
+
+
+def site_args(site):
+    return ['--host', site] if '://' in site else ['--site', site]
+
+
+class PrefixWriter:
+    """Writes complete lines prefixed with a site name to OUT, holding back an incomplete last line."""
+
+    lock = threading.Lock()
+
+    def __init__(self, out, prefix, buffered=False):
+        self.out = out
+        self.prefix = prefix
+        self.buffered = buffered
+        self.pending = ''
+        self.lines = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.pending += data
+        if '\n' in self.pending:
+            complete, self.pending = self.pending.rsplit('\n', 1)
+            self.emit(complete.split('\n'))
+
+    def emit(self, lines):
+        lines = ['%s %s\n' % (self.prefix, line) for line in lines]
+        if self.buffered:
+            self.lines += lines
+        else:
+            with self.lock:
+                self.out.write(''.join(lines))
+                self.out.flush()
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def close(self):
+        """Writes the incomplete last line and the buffered output."""
+        if self.pending:
+            self.emit([self.pending])
+            self.pending = ''
+        if self.lines:
+            with self.lock:
+                self.out.write(''.join(self.lines))
+                self.out.flush()
+            self.lines = []
+
+
+class FanOutGroup(LazyGroup):
+    """
+    A command group which runs its command once per site when the --sites or
+    --sites-file options are used, each with its own client, on a bounded thread pool.
+    """
+
+    def invoke(self, ctx):
+        sites = read_sites(ctx.params.get('sites'), ctx.params.get('sites_file'))
+        if not sites:
+            return super(FanOutGroup, self).invoke(ctx)
+
+        args = ctx.protected_args + ctx.args
+        options = ['--username', ctx.params['username'], '--password', ctx.params['password'],
+                   '--pool-size', str(ctx.params['pool_size']), '--retries', str(ctx.params['retries'])]
+        if ctx.params['timeout'] is not None:
+            options += ['--timeout', str(ctx.params['timeout'])]
+
+        grouped = ctx.params.get('group_output')
+        stdout = sys.stdout = ThreadOutput(sys.stdout)
+        stderr = sys.stderr = ThreadOutput(sys.stderr)
+
+        def run(site):
+            prefix = bgcolors.OKBLUE + site + bgcolors.ENDC
+            out = stdout.local.target = PrefixWriter(stdout.default, prefix, grouped)
+            err = stderr.local.target = PrefixWriter(stderr.default, prefix, grouped)
+            start = Timer()
+            error = None
+            try:
+                self.main(args=options + site_args(site) + args, prog_name=ctx.info_name, standalone_mode=False)
+            except click.ClickException, e:
+                error = e.format_message()
+            except SystemExit, e:
+                if e.code:
+                    error = 'exit code %s' % e.code
+            except Exception, e:
+                traceback.print_exc()
+                error = str(e) or type(e).__name__
+            finally:
+                out.close()
+                err.close()
+                stdout.local.target = None
+                stderr.local.target = None
+            return site, str(start), error
+
+        pool = ThreadPool(ctx.params.get('parallel') or len(sites))
+        try:
+            results = pool.map(run, sites)
+        finally:
+            pool.close()
+            pool.join()
+            sys.stdout = stdout.default
+            sys.stderr = stderr.default
+
+        failed = 0
+        for site, elapsed, error in results:
+            if error is None:
+                print_ok('%s %s\n' % (site, elapsed))
+            else:
+                failed += 1
+                print_fail_line('%s %s: %s' % (site, elapsed, error))
+
+        if failed:
+            ctx.exit(1)
@@ -0,0 +1,101 @@
+"""
+Concurrent health probes of PaperTrail instances.
+
+Each probe resolves the host, opens a TCP connection and times a few API
+requests using the client session directly, so the timings aren't skewed
+by redirects or request logging.
+"""
+
+import json
+import time
+import socket
+import urlparse
+import itertools
+from multiprocessing.pool import ThreadPool
+# datetime.strptime isn't thread safe until the module it uses is imported
+import _strptime
+
+from commons import *
+from client import SERVER_TIME_SCRIPT, parse_server_time
+from tasks import TIME_FORMAT, last_end
+
+PROBE_TIMEOUT = 10
+
+COLUMNS = ['site', 'dns', 'tcp', 'http', 'sessions', 'db backup age', 'tasks', 'error']
+
+
+def elapsed(start):
+    return '%dms' % ((time.time() - start) * 1000)
+
+
+def format_age(delta):
+    if delta is None:
+        return None
+    minutes = int(delta.total_seconds()) // 60
+    if minutes < 60:
+        return '%dm' % minutes
+    if minutes < 24 * 60:
+        return '%dh %dm' % (minutes // 60, minutes % 60)
+    return '%dd %dh' % (minutes // (24 * 60), minutes // 60 % 24)
+
+
+def task_states(tasks):
+    """Summarises the TASKS as the number of tasks in each state."""
+    states = sorted(task.get('state') or '?' for task in tasks)
+    return ', '.join('%s %d' % (state, len(list(group))) for state, group in itertools.groupby(states))
+
+
+def probe(site, client, timeout=PROBE_TIMEOUT):
+    """
+    Probes the CLIENT server. Returns a row of COLUMNS values; the probes after
+    the first failing one are skipped and the failure is reported in the error column.
+    """
+    row = dict.fromkeys(COLUMNS)
+    row['site'] = site
+
+    url = urlparse.urlparse(client.url)
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    session = client.session
+
+    try:
+        start = time.time()
+        address = socket.getaddrinfo(url.hostname, port, 0, socket.SOCK_STREAM)[0][4]
+        row['dns'] = elapsed(start)
+
+        start = time.time()
+        socket.create_connection(address[:2], timeout).close()
+        row['tcp'] = elapsed(start)
+
+        start = time.time()
+        r = session.get(client.url + '/tasks', timeout=timeout)
+        r.raise_for_status()
+        row['http'] = elapsed(start)
+        tasks = r.json()['items']
+        row['tasks'] = task_states(tasks)
+
+        filters = [{'value': '', 'field': 'endDate', 'type': 'null'}]
+        r = session.get(client.url + '/dao/listFull/UserSession', data={'filter': json.dumps(filters)},
+                        timeout=timeout)
+        r.raise_for_status()
+        row['sessions'] = r.json()['totalCount']
+
+        end = last_end(tasks, 'DB Backup')
+        if end is not None:
+            r = session.post(client.url + '/script/execute', data={'code': SERVER_TIME_SCRIPT}, timeout=timeout)
+            r.raise_for_status()
+            now = parse_server_time(r.text.replace('result =', '').strip())
+            row['db backup age'] = format_age(now - dt.datetime.strptime(end, TIME_FORMAT))
+    except Exception, e:
+        row['error'] = str(e).split('\n')[0] or type(e).__name__
+
+    return [row[column] for column in COLUMNS]
+
+
+def probe_sites(clients, parallel=16, timeout=PROBE_TIMEOUT):
+    """Probes the (site, client) pairs of CLIENTS concurrently. Returns the rows in the same order."""
+    pool = ThreadPool(max(1, min(parallel, len(clients))))
+    try:
+        return pool.map(lambda (site, client): probe(site, client, timeout), clients)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,141 @@
+"""
+Incremental decoding of large JSON responses.
+
+Papertrail list endpoints return an object with a big array of rows (usually "items")
+next to a few small values ("metadata", "count", "totalCount").
+The functions here decode the small values eagerly and yield the array elements
+one by one straight from the response stream.
+"""
+
+import json
+import codecs
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]}'
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """Buffers decoded text from an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Reads one more chunk. Returns False if the stream is exhausted."""
+        if self.eof:
+            return False
+
+        # Drop the consumed part of the buffer
+        if self.pos > CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += self.decoder.decode(chunk)
+                return True
+
+        self.buf += self.decoder.decode(b'', True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """Skips whitespace and returns the next character (or None at the end of the stream)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        c = self.peek()
+        if c is None or c not in chars:
+            raise ValueError('Expected %s at position %d, got %r' % (' or '.join(chars), self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Decodes the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number is complete only once it's followed by a delimiter, the next chunk
+                # may continue it ("12." + "5")
+                number = isinstance(value, (int, long, float)) and not isinstance(value, bool)
+                if self.eof or (end < len(self.buf) and (not number or self.buf[end] in DELIMITERS)):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def load(chunks, key='items', require=()):
+    """
+    Decodes a JSON object from an iterator of byte CHUNKS.
+
+    Returns a dict with all the top-level values found before KEY and KEY itself
+    mapped to a generator of its array elements. Values that follow the array
+    are added to the dict once the generator is exhausted.
+
+    If any of the REQUIRE keys come after the array in the stream, the elements are
+    buffered until they are found, so the returned dict always contains them.
+    """
+    reader = _Reader(chunks)
+    data = {}
+
+    def read_members(first):
+        """Reads object members until KEY or the end of the object. Returns True if KEY was found."""
+        while True:
+            if first:
+                first = False
+                if reader.peek() == '}':
+                    reader.pos += 1
+                    return False
+            elif reader.expect(',}') == '}':
+                return False
+
+            name = reader.value()
+            reader.expect(':')
+            if name == key and reader.peek() == '[':
+                reader.pos += 1
+                return True
+            data[name] = reader.value()
+
+    def elements():
+        if reader.peek() == ']':
+            reader.pos += 1
+        else:
+            while True:
+                yield reader.value()
+                if reader.expect(',]') == ']':
+                    break
+        read_members(False)
+
+    reader.expect('{')
+    if not read_members(True):
+        return data
+
+    items = elements()
+    if all(name in data for name in require):
+        data[key] = items
+    else:
+        data[key] = list(items)
+
+    return data
+
+
+def load_response(response, key='items', require=()):
+    """Incrementally decodes a streamed requests RESPONSE, see load()."""
+    return load(response.iter_content(CHUNK_SIZE), key, require)
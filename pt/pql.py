@@ -1,9 +1,35 @@
 import os, sys
 import atexit
 import csv, json
+import itertools
+from multiprocessing.pool import ThreadPool
+from utils import print_fail_line
 from commons import *
 
-def run_pql_repl(client):
+# Number of rows per record batch in the Arrow and Parquet outputs
+BATCH_SIZE = 10000
+
+# Number of rows used to compute column widths and written at once in the table output
+SAMPLE_SIZE = 100
+# Maximum width of a table column
+MAX_WIDTH = 40
+
+def query_pql(client, query, stream=False, cache=None, refresh=False):
+    """
+    Executes a PQL query, serving it from the CACHE if a fresh result is stored there.
+    Use REFRESH to skip the lookup and store a new result.
+    """
+    if cache is not None and not refresh:
+        response = cache.get(client, query)
+        if response is not None:
+            return response
+
+    response = client.pql_query(query, stream=stream)
+    if cache is not None and response is not None:
+        response = cache.wrap(client, query, response)
+    return response
+
+def run_pql_repl(client, cache=None):
     if os.name == 'posix':
         setup_readline()
 
@@ -17,18 +43,83 @@ def run_pql_repl(client):
             print('')
             break
 
-        response = client.pql_query(query)
+        response = query_pql(client, query, stream=True, cache=cache)
         if response is not None:
-            print_pql_response(response)
+            print_pql_response(response, pager=sys.stdout.isatty())
+
+def stream_pql_response(client, query, page_size):
+    """
+    Returns a response whose 'items' is a lazy iterator over all the result pages,
+    so it can be passed to any of the print_pql_* functions.
+    """
+    pages = client.pql_pages(query, page_size, stream=True)
+    first = next(pages, None)
+    if first is None or 'items' not in first:
+        return first
+
+    items = itertools.chain.from_iterable(page['items'] for page in itertools.chain([first], pages))
+    return {'metadata': first['metadata'], 'items': items}
+
+def read_pql_batch(file):
+    """Reads PQL queries from a FILE, one per line. Blank lines and lines starting with # are skipped."""
+    queries = []
+    for line in file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            queries.append(line)
+    return queries
+
+def run_pql_batch(client, queries, out_dir, format='csv', parallel=4, cache=None, refresh=False):
+    """
+    Runs QUERIES concurrently on a pool of PARALLEL threads sharing one client.
+    Each result is written to its own file in OUT_DIR, named after the query index.
+    Returns a list of (query, path, elapsed time, error) tuples in the order of QUERIES.
+    """
+    writers = {'csv': print_pql_csv, 'json': print_pql_json, 'column': print_pql_column, 'user': print_pql_response,
+               'ndjson': print_pql_ndjson, 'arrow': print_pql_arrow, 'parquet': print_pql_parquet}
+    extensions = {'csv': 'csv', 'json': 'json', 'column': 'txt', 'user': 'txt',
+                  'ndjson': 'ndjson', 'arrow': 'arrow', 'parquet': 'parquet'}
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    def run(args):
+        i, query = args
+        path = os.path.join(out_dir, 'query_%d.%s' % (i + 1, extensions[format]))
+        start = Timer()
+        try:
+            response = query_pql(client, query, True, cache, refresh)
+            if response is None:
+                return query, path, str(start), 'no response'
+            with open(path, 'wb') as f:
+                writers[format](response, f)
+            return query, path, str(start), None
+        except Exception, e:
+            return query, path, str(start), str(e)
+
+    pool = ThreadPool(parallel)
+    try:
+        results = pool.map(run, list(enumerate(queries)))
+    finally:
+        pool.close()
+        pool.join()
+
+    for query, path, elapsed, error in results:
+        if error is None:
+            print_ok('%s %s (%s)\n' % (path, query, elapsed))
+        else:
+            print_fail_line('%s %s (%s): %s' % (path, query, elapsed, error))
 
-def print_pql_csv(data):
+    return results
+
+def print_pql_csv(data, out=None):
     if 'count' in data and data['count'] == 0:
         return
 
     if not ('items' in data):
         raise Exception('Invalid data in response:', data)
 
-    csvwriter = csv.writer(sys.stdout)
+    csvwriter = csv.writer(out or sys.stdout)
 
     # Write header
     csvwriter.writerow(map(lambda meta: meta['label'], data['metadata']))
@@ -37,24 +128,154 @@ def print_pql_csv(data):
     for row in data['items']:
         csvwriter.writerow(row)
 
-def print_pql_json(data):
-    print(json.dumps(data, indent=2))
+def print_pql_column(data, out=None):
+    """Prints the first column of each result row"""
+    out = out or sys.stdout
+    for row in data['items']:
+        out.write(unicode(row[0]).encode('utf-8') + '\n')
+
+def print_pql_json(data, out=None):
+    out = out or sys.stdout
+
+    if isinstance(data.get('items'), list):
+        out.write(json.dumps(data, indent=2) + '\n')
+        return
+
+    # Streamed response: write the items one by one
+    out.write('{')
+    for key in data.keys():
+        if key != 'items':
+            out.write('\n  %s: %s,' % (json.dumps(key), json.dumps(data[key])))
+
+    written = set(data.keys())
+    out.write('\n  "items": [')
+    for i, row in enumerate(data['items']):
+        out.write((',\n    ' if i else '\n    ') + json.dumps(row))
+    out.write('\n  ]')
 
-def print_pql_response(data):
+    # Values that followed the items in the response
+    for key in data.keys():
+        if key not in written:
+            out.write(',\n  %s: %s' % (json.dumps(key), json.dumps(data[key])))
+    out.write('\n}\n')
+
+def print_pql_ndjson(data, out=None):
+    """Prints each result row as a JSON object keyed by the column labels, one per line"""
+    if not ('items' in data):
+        raise Exception('Invalid data in response:', data)
+
+    out = out or sys.stdout
+    labels = [meta['label'] for meta in data['metadata']]
+
+    for row in data['items']:
+        out.write(json.dumps(dict(zip(labels, row))) + '\n')
+
+def iter_pql_batches(data):
+    """Yields Arrow record batches of BATCH_SIZE rows, all columns typed as strings"""
+    import pyarrow as pa
+
+    labels = [meta['label'] for meta in data['metadata']]
+    schema = pa.schema([pa.field(label, pa.string()) for label in labels])
+
+    def to_batch(rows):
+        columns = zip(*rows) if rows else [[] for label in labels]
+        arrays = [pa.array([None if v is None else unicode(v) for v in column], type=pa.string())
+                  for column in columns]
+        return pa.RecordBatch.from_arrays(arrays, labels)
+
+    yield schema
+
+    rows = []
+    for row in data['items']:
+        rows.append(row)
+        if len(rows) == BATCH_SIZE:
+            yield to_batch(rows)
+            rows = []
+
+    if rows:
+        yield to_batch(rows)
+
+def _import_pyarrow(format):
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise Exception('The %s format requires pyarrow, install it with "pip install pyarrow"' % format)
+
+def print_pql_arrow(data, out=None):
+    """Writes the result as an Arrow IPC stream"""
+    pa = _import_pyarrow('arrow')
+
+    if not ('items' in data):
+        raise Exception('Invalid data in response:', data)
+
+    batches = iter_pql_batches(data)
+    schema = next(batches)
+    writer = pa.RecordBatchStreamWriter(out or sys.stdout, schema)
+    for batch in batches:
+        writer.write_batch(batch)
+    writer.close()
+
+def print_pql_parquet(data, out=None):
+    """Writes the result as a Parquet file, one row group per batch"""
+    pa = _import_pyarrow('parquet')
+    import pyarrow.parquet as pq
+
+    if not ('items' in data):
+        raise Exception('Invalid data in response:', data)
+
+    batches = iter_pql_batches(data)
+    schema = next(batches)
+    writer = pq.ParquetWriter(out or sys.stdout, schema)
+    for batch in batches:
+        writer.write_table(pa.Table.from_batches([batch]))
+    writer.close()
+
+def _cell(value, width):
+    text = u'' if value is None else unicode(value).replace('\n', ' ').replace('\r', ' ')
+    if len(text) > width:
+        text = text[:width - 3] + u'...' if width > 3 else text[:width]
+    return text.ljust(width)
+
+def print_pql_response(data, out=None, max_width=MAX_WIDTH, pager=False):
+    """
+    Prints response as a table in a human-readable format.
+    Column widths are computed from the first SAMPLE_SIZE rows and cells longer than MAX_WIDTH are truncated.
+    Rows are written in chunks of SAMPLE_SIZE; with PAGER the user is prompted before each next chunk.
+    """
     if 'count' in data and data['count'] == 0:
         return
 
-    """Prints response in a human-readable format"""
     if not ('items' in data):
         raise Exception('Invalid data in response:', data)
 
-    columns = data['metadata']
-    items = data['items']
+    out = out or sys.stdout
+    labels = [meta['label'] for meta in data['metadata']]
+    items = iter(data['items'])
+    chunk = list(itertools.islice(items, SAMPLE_SIZE))
+
+    widths = [min(max_width, max([len(label)] + [len(unicode(row[i])) for row in chunk if row[i] is not None]))
+              for i, label in enumerate(labels)]
+
+    def render(row):
+        return u' | '.join(_cell(value, widths[i]) for i, value in enumerate(row)).rstrip() + u'\n'
+
+    lines = [render(labels), u'-+-'.join(u'-' * width for width in widths) + u'\n']
+    count = 0
+
+    while chunk:
+        count += len(chunk)
+        lines.extend(render(row) for row in chunk)
+        out.write(u''.join(lines).encode('utf-8'))
+        out.flush()
+        lines = []
+
+        chunk = list(itertools.islice(items, SAMPLE_SIZE))
+        if chunk and pager:
+            if raw_input('-- %d rows, Enter for more, q to stop --' % count).strip().lower() == 'q':
+                return
 
-    for item in items:
-        for i, column in enumerate(columns):
-            print(column['label'] + ": " + item[i])
-        print('---')
+    out.write('(%d rows)\n' % count)
 
 def setup_readline():
     import readline
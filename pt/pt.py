@@ -1,38 +1,50 @@
 #!/usr/bin/env python
 
 import sys
-import webbrowser
 import json
+import csv
 import os
 import os.path
 from os.path import basename
 
 import click
-import colorama
 
-from client import Client
-from pql import print_pql_response, print_pql_csv, print_pql_json, run_pql_repl
-import service
+from client import get_client, PqlPageError
+from pql import print_pql_response, print_pql_csv, print_pql_json, print_pql_column, print_pql_ndjson, \
+    print_pql_arrow, print_pql_parquet, run_pql_repl, \
+    stream_pql_response, read_pql_batch, run_pql_batch, query_pql
+from cache import PqlCache, ArtifactCache
+from sync import sync_files, sync_tree
+from transfer import write_response, download_file, download_path
 import commands
-from utils import bgcolors, load_site_config, download_file
-import tempfile
-from cookiecutter.main import cookiecutter
-import subprocess
+from fanout import FanOutGroup, read_sites
+from utils import bgcolors, load_site_config, register_site, print_fail_line
 
 from commons import *
 
 
-@click.group()
-@click.option('--site', required=False, envvar='PT_SITE', help='Name of the file with site credentials')
+@click.group(cls=FanOutGroup)
+@click.option('--site', required=False, envvar='PT_SITE',
+              help='Name of the file with site credentials in ., sites or ~/.pt/sites (or the PT_SITES_PATH directories)')
+@click.option('--sites', help='Comma separated site names or host URLs to run the command on concurrently')
+@click.option('--sites-file', type=click.Path(exists=True, dir_okay=False), help='File with a site name or host URL per line')
+@click.option('--parallel', default=8, help='Number of sites to run the command on concurrently')
+@click.option('--group-output', is_flag=True, default=False, help='Print the output of each site at once instead of line by line')
 @click.option('--username', default='admin', envvar=['PT_USER', 'PT_API_USER'], help='or use the PT_USER/PT_API_USER environment variable')
 @click.option('--password', default='p', envvar=['PT_PASS', 'PT_API_PASS'], help='or use the PT_PASS/PT_API_PASS environment variable')
 @click.option('--host', default='http://localhost:8080', envvar='PT_API', help='or use the PT_API environment variable')
+@click.option('--pool-size', default=10, envvar='PT_POOL_SIZE', help='Maximum number of kept-alive connections to the server')
+@click.option('--retries', default=3, envvar='PT_RETRIES', help='Number of retries for failed idempotent requests')
+@click.option('--timeout', type=int, envvar='PT_TIMEOUT', help='Response timeout in seconds, none by default')
 @click.pass_context
-def papertrail(ctx, host, username, password, site):
-    if site is not None:
-        if os.name == 'nt':
-            raise Exception('--site is not supported on Windows')
+def papertrail(ctx, host, username, password, site, pool_size, retries, timeout, sites, sites_file, parallel,
+               group_output):
+    ctx.obj = site_client(site, host, username, password, pool_size=pool_size, retries=retries, timeout=timeout)
+
 
+def site_client(site, host, username, password, **kwargs):
+    """Returns a client for a SITE config, or for HOST if SITE is None."""
+    if site is not None:
         env = load_site_config(site)
 
         if env is None:
@@ -47,7 +59,7 @@ def papertrail(ctx, host, username, password, site):
     if not host.startswith('http://') and not host.startswith('https://'):
         host = 'http://' + host
 
-    ctx.obj = Client(host, username, password)
+    return get_client(host, username, password, **kwargs)
 
 
 @papertrail.command()
@@ -63,6 +75,8 @@ def login(host, username, password, file):
     f.write('PT_USER=%s\0' % username)
     f.write('PT_API_PASS=%s\0' % password)
     f.write('PT_PASS=%s\0' % password)
+    f.close()
+    register_site(basename(file), file)
 
 
 @papertrail.command()
@@ -70,7 +84,7 @@ def login(host, username, password, file):
 @click.pass_obj
 def deploy(client, file):
     """Deploys a package from a local FILE"""
-    client.deploy_package(basename(file.name), file)
+    client.deploy_package(basename(file.name), file, progress=True)
 
 
 @papertrail.command()
@@ -78,6 +92,9 @@ def deploy(client, file):
 @click.pass_obj
 def create_project(client, name):
     """Creates a new project for PaperTrail"""
+    import subprocess
+    from cookiecutter.main import cookiecutter
+
     print("Downloading https://github.com/egis/ProjectBootstrap...")
     path = cookiecutter('https://github.com/egis/ProjectBootstrap.git', no_input=True, output_dir=name)
     gradle_exec = "gradle"
@@ -93,19 +110,26 @@ def create_project(client, name):
 @papertrail.command()
 @click.argument('url')
 @click.argument('filename')
+@click.option('--cache', is_flag=True, default=False,
+              help='Keep the package in the local artifact cache, only for URLs whose content never changes')
 @click.pass_obj
-def deploy_url(client, url, filename):
-    temp = tempfile.NamedTemporaryFile()
-    download_file(url, temp.name)
-    client.deploy_package(filename, temp)
-    temp.close()
+def deploy_url(client, url, filename, cache):
+    path = download_path(url)
+    if cache:
+        ArtifactCache().fetch(url, url, path, progress=True)
+    else:
+        download_file(url, path, progress=True)
+    with open(path, 'rb') as f:
+        client.deploy_package(filename, f, progress=True)
+    os.remove(path)
 
 
 @papertrail.command()
 @click.argument('project')
 @click.option('--install', is_flag=True, default=False, help='Deploy the install package instead of the upgrade package')
+@click.option('--no-cache', is_flag=True, default=False, help="Download the package even if it's in the local artifact cache")
 @click.pass_obj
-def deploy_ci(client, project, install):
+def deploy_ci(client, project, install, no_cache):
     """Deploys a package by downloading the latest CircleCI artifact using ci:<user>/<repo>
     Requires the CIRCLECI environment variable be set with an access token
     """
@@ -120,9 +144,16 @@ def deploy_ci(client, project, install):
         elif not install and file["pretty_path"].endswith("-upgrade.zip"):
             url = file["url"]
 
-    temp = tempfile.NamedTemporaryFile(delete=False)
-    download_file(url + "?circle-token=%s" % (os.environ['CIRCLECI']), temp.name)
-    client.deploy_package(project + ".zip", temp)
+    # The artifact URL identifies the build, the token is left out of the cache key and the download path
+    path = download_path(url)
+    download_url = url + "?circle-token=%s" % (os.environ['CIRCLECI'])
+    if no_cache:
+        download_file(download_url, path, progress=True)
+    else:
+        ArtifactCache().fetch(url, download_url, path, progress=True)
+    with open(path, 'rb') as f:
+        client.deploy_package(project + ".zip", f, progress=True)
+    os.remove(path)
 
 
 @papertrail.command()
@@ -134,19 +165,44 @@ def redeploy(client):
 
 @papertrail.command()
 @click.argument('query', required=False)
-@click.option('--format', default='user', type=click.Choice(['user', 'csv', 'json', 'column']),
+@click.option('--format', default='user', type=click.Choice(['user', 'csv', 'json', 'column', 'ndjson', 'arrow', 'parquet']),
               help='Data output format')
+@click.option('--stream', is_flag=True, default=False,
+              help='Fetch the result page by page, the query needs an ORDER BY for consistent pages')
+@click.option('--page-size', default=1000, help='Number of rows per page when streaming')
+@click.option('--batch', type=click.File('rt'), help='File with queries to run, one per line')
+@click.option('--parallel', default=4, help='Number of batch queries to run concurrently')
+@click.option('--out', default='.', help='Directory to write batch results to')
+@click.option('--max-width', default=40, help='Maximum column width in the "user" format')
+@click.option('--no-cache', is_flag=True, default=False, help='Always query the server')
+@click.option('--refresh', is_flag=True, default=False, help='Query the server and update the cached result')
+@click.option('--cache-ttl', default=300, envvar='PT_PQL_CACHE_TTL', help='Seconds a cached result stays fresh')
+@click.option('--cache-size', default=100, envvar='PT_PQL_CACHE_SIZE', help='Maximum cache size in megabytes')
 @click.pass_obj
-def pql(client, query, format):
+def pql(client, query, format, stream, page_size, batch, parallel, out, max_width, no_cache, refresh, cache_ttl,
+        cache_size):
     """
     Executes a PQL query and outputs the result.
 
     Starts an interactive query shell if no query is provided.
 
     Use FORMAT option to provide an output format.
-    "user" outputs human-readable data (it's used by default).
+    "user" outputs a human-readable table (it's used by default).
     "column" outputs the first column of each result row (it's useful e.g. for xargs).
     "csv" and "json" outputs data in the respective formats.
+    "ndjson" outputs one JSON object per row, keyed by the column labels.
+    "arrow" and "parquet" write Arrow IPC stream and Parquet files (requires pyarrow).
+
+    Use STREAM option to fetch large results in pages of PAGE_SIZE rows,
+    keeping memory usage flat regardless of the result size. The pages are
+    fetched with LIMIT/OFFSET, so the query can't have its own LIMIT and should
+    have an ORDER BY on a unique column.
+
+    Use BATCH option to run every query from a file concurrently, writing each
+    result to its own file in the OUT directory.
+
+    Results are cached on disk for CACHE_TTL seconds, use NO_CACHE to bypass the cache
+    or REFRESH to update it.
 
     \033[1mExamples\033[0m
 
@@ -161,22 +217,51 @@ def pql(client, query, format):
     with the JSON output and jq:
 
       pt pql --format json "SELECT docId FROM node" | jq '.items[0]'
+
+    exporting a large result:
+
+      pt pql --stream --page-size 5000 --format csv "SELECT docId FROM node ORDER BY docId" > docs.csv
+
+    running nightly reports:
+
+      pt pql --batch reports.pql --parallel 8 --format csv --out reports/
+
+    loading into pandas:
+
+      pt pql --stream --format parquet "SELECT docId, name FROM node ORDER BY docId" > docs.parquet
     """
-    if query is None:
-        run_pql_repl(client)
+    cache = None
+    if not no_cache:
+        cache = PqlCache(ttl=cache_ttl, max_size=cache_size * 1024 * 1024)
+
+    if batch is not None:
+        run_pql_batch(client, read_pql_batch(batch), out, format, parallel, cache, refresh)
+    elif query is None:
+        run_pql_repl(client, cache)
     else:
-        response = client.pql_query(query)
-        sys.stderr.write('\nRunning %s\n\n' % query)
-        if response is not None:
-            if format == 'user':
-                print_pql_response(response)
-            elif format == 'csv':
-                print_pql_csv(response)
-            elif format == 'column':
-                for row in response['items']:
-                    print(row[0])
-            elif format == 'json':
-                print_pql_json(response)
+        try:
+            if stream:
+                response = stream_pql_response(client, query, page_size)
+            else:
+                response = query_pql(client, query, True, cache, refresh)
+            sys.stderr.write('\nRunning %s\n\n' % query)
+            if response is not None:
+                if format == 'user':
+                    print_pql_response(response, max_width=max_width)
+                elif format == 'csv':
+                    print_pql_csv(response)
+                elif format == 'column':
+                    print_pql_column(response)
+                elif format == 'json':
+                    print_pql_json(response)
+                elif format == 'ndjson':
+                    print_pql_ndjson(response)
+                elif format == 'arrow':
+                    print_pql_arrow(response)
+                elif format == 'parquet':
+                    print_pql_parquet(response)
+        except PqlPageError, e:
+            raise click.ClickException(str(e))
 
 
 @papertrail.command(name="eval")
@@ -261,6 +346,8 @@ def _service(action):
 
     Use the PT_ROOT environment variable to override the default installation path.
     """
+    import service
+
     if action == 'start':
         if service.get_status() is not None:
             click.echo("PaperTrail already started")
@@ -283,6 +370,47 @@ def _service(action):
             click.echo("PaperTrail not started")
 
 
+@papertrail.command()
+@click.argument('action', type=click.Choice(['start', 'stop', 'restart', 'status', 'run']))
+def daemon(action):
+    """
+    Manages a background pt process which keeps connections to the servers open.
+
+    While it's running, the get, pql, eval, info, sessions, tasks, logs, export,
+    new_token, redeploy and get_backup_config commands are forwarded to it.
+    Use "run" to start it in the foreground.
+    """
+    import daemon as pt_daemon
+
+    if os.name == 'nt':
+        raise click.UsageError('daemon is not supported on Windows')
+
+    if action in ['stop', 'restart']:
+        if pt_daemon.stop():
+            click.echo('Stopped pt daemon')
+        elif action == 'stop':
+            click.echo('pt daemon is not running')
+
+    if action in ['start', 'restart']:
+        pid = pt_daemon.get_pid()
+        if pid is not None:
+            click.echo('pt daemon already started (%d)' % pid)
+        else:
+            pid = pt_daemon.start()
+            if pid is None:
+                click.echo('Error starting pt daemon, please check %s for details' % pt_daemon.LOG_FILE)
+            else:
+                click.echo('Started pt daemon (%d) on %s' % (pid, pt_daemon.SOCKET_PATH))
+    elif action == 'status':
+        pid = pt_daemon.get_pid()
+        if pid is not None:
+            click.echo('pt daemon started (%d) on %s' % (pid, pt_daemon.SOCKET_PATH))
+        else:
+            click.echo('pt daemon not started')
+    elif action == 'run':
+        pt_daemon.serve()
+
+
 @papertrail.command()
 @click.argument('file', type=click.File('rt'))
 @click.pass_obj
@@ -301,24 +429,116 @@ def upload(client, path, file):
 
     E.g. upload System/scripts/TEST.groovy build/libTest.groovy
     """
-    click.echo(client.update_document(path, file).text)
+    click.echo(client.update_document(path, file, progress=True).text)
+
+
+@papertrail.command(name='upload-tree')
+@click.argument('local_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('remote_node')
+@click.option('--parallel', default=4, help='Number of files to upload concurrently')
+@click.option('--no-redeploy', is_flag=True, default=False, help='Do not redeploy workflows after the upload')
+@click.option('--sync', is_flag=True, default=False, help='Only upload files changed since the last sync')
+@click.option('--remote-hashes', is_flag=True, default=False,
+              help='Compare with the documents on the server instead of the local manifest when syncing')
+@click.pass_context
+def upload_tree(ctx, local_dir, remote_node, parallel, no_redeploy, sync, remote_hashes):
+    """
+    Uploads all files from LOCAL_DIR to REMOTE_NODE, keeping the directory structure.
+
+    Workflows are redeployed once after all the files are uploaded.
+    Use SYNC to skip files whose content hash matches the last upload to this server.
+
+    E.g. upload-tree resources/System/scripts System/scripts --parallel 8
+    """
+    client = ctx.obj
+    start = Timer()
+    if sync:
+        results = sync_tree(client, local_dir, remote_node, parallel, remote_hashes, not no_redeploy)
+    else:
+        results = client.upload_tree(local_dir, remote_node, parallel, not no_redeploy)
+
+    failed = 0
+    for path, status, error in results:
+        if error is not None:
+            failed += 1
+            # Ends the status line of the last request
+            sys.stderr.write('\n')
+            print_fail_line('%s [%s] %s' % (path, status, error))
+
+    print_info('\nUploaded %d of %d files in %s\n' % (len(results) - failed, len(results), start))
+    if failed:
+        ctx.exit(1)
 
 
 @papertrail.command()
-@click.argument('path')
+@click.argument('path', required=False)
 @click.argument('dest_file', required=False)
-@click.pass_obj
-def download(client, path, dest_file):
-    """Downloads a remote PATH to DEST_FILE"""
+@click.option('--query', help='PQL query selecting the paths of the documents to download in its first column')
+@click.option('--out', default='.', help='Directory to download the queried documents to')
+@click.option('--parallel', default=4, help='Number of documents to download concurrently')
+@click.option('--retries', default=3, help='Number of times to retry a failed download')
+@click.pass_context
+def download(ctx, path, dest_file, query, out, parallel, retries):
+    """
+    Downloads a remote PATH to DEST_FILE, resuming an interrupted download.
+
+    Use QUERY to download all the selected documents into the OUT directory instead.
+    A manifest.csv of the fetched documents is written there.
+
+    E.g. download --query "SELECT path FROM node WHERE ..." --out docs --parallel 8
+    """
+    client = ctx.obj
+    if query is not None:
+        if not download_query(client, query, out, parallel, retries):
+            ctx.exit(1)
+        return
+
+    if path is None:
+        raise click.BadParameter('either PATH or --query is required')
+
     full_path = 'public/file/{0}/{1}'.format(path, basename(path))
-    response = client.get(full_path)
 
-    if response.status_code == 200:
-        if dest_file is None:
-            dest_file = basename(path)
+    if dest_file is None:
+        dest_file = basename(path)
+
+    if not client.download(full_path, dest_file, progress=True):
+        ctx.exit(1)
 
-        with open(dest_file, 'w') as f:
-            f.write(response.text)
+
+def download_query(client, query, out, parallel, retries):
+    """Downloads the documents selected by QUERY, returns True if all of them were downloaded."""
+    response = client.pql_query(query, stream=True)
+    if response is None:
+        return False
+    if 'items' not in response:
+        raise Exception('Invalid data in response:', response)
+
+    if not os.path.isdir(out):
+        os.makedirs(out)
+
+    start = Timer()
+    total = 0
+    failed = 0
+    paths = (row[0] for row in response['items'])
+
+    with open(os.path.join(out, 'manifest.csv'), 'wb') as f:
+        manifest = csv.writer(f)
+        manifest.writerow(['path', 'file', 'size', 'error'])
+
+        for path, dest_file, error in client.download_documents(paths, out, parallel, retries):
+            total += 1
+            if error is None:
+                manifest.writerow([path, dest_file, os.path.getsize(dest_file), ''])
+            else:
+                failed += 1
+                manifest.writerow([path, dest_file, '', error])
+                # Ends the status line of the last request
+                sys.stderr.write('\n')
+                print_fail_line('%s: %s' % (path, error))
+            f.flush()
+
+    print_info('\nDownloaded %d of %d documents in %s\n' % (total - failed, total, start))
+    return not failed
 
 
 @papertrail.command()
@@ -329,14 +549,10 @@ def download_script(client, script, dest_file):
     """Downloads a remote SCRIPT to DEST_FILE"""
     path = 'public/file/System/scripts/{0}/{0}'.format(script)
 
-    response = client.get(path)
-
-    if response.status_code == 200:
-        if dest_file is None:
-            dest_file = script
+    if dest_file is None:
+        dest_file = script
 
-        with open(dest_file, 'w') as f:
-            f.write(response.text)
+    client.download(path, dest_file)
 
 
 @papertrail.command()
@@ -345,15 +561,21 @@ def download_script(client, script, dest_file):
 @click.pass_obj
 def update_doc(client, node, file):
     """Updates a document located at NODE/FILE from a local FILE."""
-    click.echo(client.update_document('{}/{}'.format(node, basename(file.name)), file).text)
+    click.echo(client.update_document('{}/{}'.format(node, basename(file.name)), file, progress=True).text)
 
 
 @papertrail.command()
 @click.argument('file', type=click.File('rt'))
+@click.option('--sync', is_flag=True, default=False, help='Skip the upload if the script did not change since the last sync')
 @click.pass_obj
-def update_script(client, file):
+def update_script(client, file, sync):
     """Uploads and updates the script document from a provided FILE"""
-    client.upload_script(basename(file.name), file)
+    if sync:
+        path = 'System/scripts/{}'.format(basename(file.name))
+        if not sync_files(client, [(path, file.name)], redeploy=True):
+            print_info('%s is up to date\n' % path)
+    else:
+        client.upload_script(basename(file.name), file)
 
 
 @papertrail.command()
@@ -377,6 +599,7 @@ def new_token(client, url, **kwargs):
     token=client.new_token(url)
     click.echo(token)
     if kwargs['open']:
+        import webbrowser
         webbrowser.open(token);
 
 
@@ -398,15 +621,26 @@ def new(client, form_name, **kwargs):
     token = client.new_token('/web/eSign')
     click.echo(doc_id)
     if kwargs['open']:
+       import webbrowser
        webbrowser.open('{}?{}'.format(token, doc_id))
 
 
 @form.command(name="export")
 @click.argument('docid')
+@click.argument('dest_file', required=False)
 @click.pass_obj
-def form_export(client, docid):
-    """Creates a new form from a provided FORM_NAME"""
-    click.echo(client.get('public/file/%s/saved.json?path=saved.json' % docid).text)
+def form_export(client, docid, dest_file):
+    """Exports the saved data of a form DOCID to DEST_FILE or the standard output"""
+    path = 'public/file/%s/saved.json?path=saved.json' % docid
+
+    if dest_file is not None:
+        client.download(path, dest_file)
+        return
+
+    response = client.get(path, stream=True)
+    if response is not None and response.status_code == 200:
+        write_response(response, sys.stdout)
+        sys.stdout.write('\n')
 
 
 @form.command(name="list")
@@ -427,6 +661,7 @@ def new_classic(client, form_name, **kwargs):
     click.echo(doc_id)
     token = client.new_token('/jsForm/edit/')
     if kwargs['open']:
+       import webbrowser
        webbrowser.open('{}?{}'.format(token, doc_id))
 
 
@@ -466,6 +701,77 @@ def tasks(client):
     client.task_list()
 
 
+@papertrail.command(name='wait-task')
+@click.argument('name')
+@click.option('--since', help='Server time (YYYY-MM-DD HH:MM) the task must end after, defaults to now')
+@click.option('--timeout', default=30 * 60, help='Seconds to wait for the task')
+@click.option('--max-interval', default=30, help='Maximum number of seconds between polls')
+@click.pass_obj
+def wait_task(client, name, since, timeout, max_interval):
+    """Waits until a server task NAME ends."""
+    from tasks import TaskWatcher, TIME_FORMAT
+
+    if since is not None:
+        try:
+            since = dt.datetime.strptime(since, TIME_FORMAT)
+        except ValueError:
+            raise click.BadParameter('expected YYYY-MM-DD HH:MM', param_hint='--since')
+
+    start = Timer()
+    watcher = TaskWatcher(client, max_interval=max_interval, timeout=timeout)
+
+    def changed(task):
+        print_info('%s: %s %s\n' % (task['name'], task.get('state'), task.get('status') or ''))
+
+    task = watcher.wait(name, since, changed)
+    if task is None:
+        raise click.ClickException('%s did not end in %s seconds' % (name, timeout))
+    print_ok('%s ended at %s: %s %s in %s\n' % (name, task['end'], task.get('state'), task.get('status') or '', start))
+
+
+@papertrail.command()
+@click.option('--sites', help='Comma separated site names or host URLs to probe')
+@click.option('--sites-file', type=click.Path(exists=True, dir_okay=False), help='File with a site name or host URL per line')
+@click.option('--parallel', default=16, help='Number of sites to probe concurrently')
+@click.option('--timeout', default=10, help='Timeout of each probe in seconds')
+@click.option('--watch', type=int, help='Probe again every WATCH seconds, refreshing the table')
+@click.pass_context
+def health(ctx, sites, sites_file, parallel, timeout, watch):
+    """
+    Probes the DNS, TCP connect and HTTP latencies, the active sessions, the last
+    database backup age and the task states of each site and prints them as a table.
+    Probes the current server if no sites are given.
+    """
+    from health import COLUMNS, probe_sites
+
+    params = ctx.parent.params
+    options = dict(pool_size=params['pool_size'], retries=0, timeout=timeout)
+    names = read_sites(sites, sites_file)
+    if names:
+        clients = [(name, site_client(None, name, params['username'], params['password'], **options) if '://' in name
+                    else site_client(name, params['host'], params['username'], params['password'], **options))
+                   for name in names]
+    else:
+        clients = [(ctx.obj.url, ctx.obj)]
+
+    refresh = watch and sys.stdout.isatty()
+    while True:
+        start = Timer()
+        rows = probe_sites(clients, parallel, timeout)
+        if refresh:
+            sys.stdout.write('\033[H\033[J')
+        print_pql_response({'metadata': [{'label': label} for label in COLUMNS], 'items': rows})
+        failed = sum(1 for row in rows if row[-1] is not None)
+        print('%d sites probed in %s, %d failed' % (len(rows), start, failed))
+
+        if not watch:
+            break
+        time.sleep(watch)
+
+    if failed:
+        ctx.exit(1)
+
+
 @papertrail.command()
 @click.option('--info', is_flag=True, default=False)
 @click.pass_obj
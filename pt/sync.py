@@ -0,0 +1,102 @@
+"""
+Incremental uploads based on content hashes.
+
+A manifest of SHA-1 hashes of the uploaded documents is kept per server,
+so only files whose content changed since the last upload are sent again.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+from client import tree_files
+from transfer import file_checksum
+from utils import atomic_write
+
+SYNC_DIR = os.getenv('PT_SYNC_DIR', os.path.join(os.path.expanduser('~'), '.pt', 'sync'))
+
+
+class Manifest:
+    """Remote path -> content hash of the documents uploaded to a server."""
+
+    # Concurrent builders sync to the same server and share its manifest file
+    lock = threading.Lock()
+
+    def __init__(self, client, directory=SYNC_DIR):
+        key = '\0'.join([client.url, client.username or ''])
+        self.path = os.path.join(directory, hashlib.sha1(key).hexdigest() + '.json')
+        self.hashes = self.load()
+        self.updated = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, path):
+        return self.hashes.get(path)
+
+    def update(self, path, digest):
+        self.hashes[path] = digest
+        self.updated[path] = digest
+
+    def save(self):
+        """Writes the updated hashes over the latest manifest, keeping the updates saved by others since it was read."""
+        with self.lock:
+            self.hashes = self.load()
+            self.hashes.update(self.updated)
+            with atomic_write(self.path, 'wt') as f:
+                json.dump(self.hashes, f, indent=2, sort_keys=True)
+        self.updated = {}
+
+
+def changed_files(client, files, manifest, remote=False, parallel=4):
+    """
+    Returns the (remote path, local path, hash) triples of FILES whose content differs
+    from the MANIFEST. With REMOTE the hashes are taken from the server documents instead.
+    """
+    def check(args):
+        path, local_path = args
+        digest = file_checksum(local_path, 'sha1')
+        known = client.document_hash(path) if remote else manifest.get(path)
+        return path, local_path, digest, known
+
+    pool = ThreadPool(parallel)
+    try:
+        checked = pool.map(check, files)
+    finally:
+        pool.close()
+        pool.join()
+
+    return [(path, local_path, digest) for path, local_path, digest, known in checked if digest != known]
+
+
+def sync_files(client, files, parallel=4, remote=False, redeploy=False):
+    """
+    Uploads only the changed FILES, a list of (remote path, local path) pairs,
+    and records their hashes in the manifest.
+    Returns the upload results of the changed files, see Client.upload_files.
+    """
+    manifest = Manifest(client)
+    changed = changed_files(client, files, manifest, remote, parallel)
+
+    results = client.upload_files([(path, local_path) for path, local_path, digest in changed], parallel)
+
+    for (path, local_path, digest), (_, status, error) in zip(changed, results):
+        if error is None:
+            manifest.update(path, digest)
+    manifest.save()
+
+    if redeploy and any(error is None for path, status, error in results):
+        client.redeploy_workflow()
+
+    return results
+
+
+def sync_tree(client, local_dir, node, parallel=4, remote=False, redeploy=True):
+    """Uploads the changed files under LOCAL_DIR to the matching paths under NODE."""
+    return sync_files(client, tree_files(local_dir, node), parallel, remote, redeploy)
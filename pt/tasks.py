@@ -0,0 +1,73 @@
+"""
+Waiting for server tasks.
+
+The task list is fetched once per poll and the server clock is read once,
+the server time is then derived from the local clock and the measured skew.
+"""
+
+import time
+import datetime as dt
+
+# Task start and end times are reported with a minute precision
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+INTERVAL = 1
+MAX_INTERVAL = 30
+TIMEOUT = 30 * 60
+
+
+def last_end(tasks, name):
+    """Returns the latest end time of the TASKS named NAME, see Client.last_task_time."""
+    ends = [task['end'] for task in tasks if task['name'] == name and 'end' in task]
+    return max(ends) if ends else None
+
+
+class TaskWatcher:
+    """Polls the task list of a server with an exponential backoff."""
+
+    def __init__(self, client, server_time=None, interval=INTERVAL, max_interval=MAX_INTERVAL, timeout=TIMEOUT):
+        self.client = client
+        self.interval = interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.skew = None if server_time is None else server_time - dt.datetime.now()
+
+    def server_time(self):
+        """Returns the server time, reading the server clock only the first time."""
+        if self.skew is None:
+            self.skew = self.client.server_time() - dt.datetime.now()
+        return dt.datetime.now() + self.skew
+
+    def tasks(self):
+        r = self.client.get('tasks')
+        if r is None or not r.ok:
+            return None
+        return r.json()['items']
+
+    def wait(self, name, since=None, on_change=None):
+        """
+        Waits until a task named NAME ends at or after SINCE, the server time by default.
+        ON_CHANGE is called with the task when its state changes.
+        Returns the task, or None if it didn't end within the timeout.
+        """
+        since = (since or self.server_time()).strftime(TIME_FORMAT)
+        deadline = time.time() + self.timeout
+        interval = self.interval
+        state = None
+
+        while True:
+            tasks = self.tasks() or []
+            matching = [task for task in tasks if task['name'] == name]
+            ended = [task for task in matching if task.get('end', '') >= since]
+            if ended:
+                return max(ended, key=lambda task: task['end'])
+
+            if matching and on_change is not None and matching[0].get('state') != state:
+                state = matching[0].get('state')
+                on_change(matching[0])
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_interval)
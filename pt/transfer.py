@@ -0,0 +1,347 @@
+"""
+Streaming uploads and downloads with progress reporting.
+"""
+
+import os
+import re
+import json
+import uuid
+import hashlib
+import tempfile
+import threading
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+
+# Segmented downloads
+SEGMENTS = 4
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# Seconds to wait for a connection and between received chunks
+DOWNLOAD_TIMEOUT = (10, 60)
+
+
+def progress_bar(size):
+    """Returns a progress bar reporting transferred data size, throughput and ETA."""
+    import progressbar
+
+    return progressbar.ProgressBar(max_value=size or progressbar.UnknownLength,
+                                   widgets = [ progressbar.DataSize(), progressbar.Bar(), ' ',
+                                               progressbar.FileTransferSpeed(), ' | ',
+                                               progressbar.Timer(), ', ',
+                                               progressbar.ETA() ])
+
+
+def file_size(file_obj):
+    """Returns the number of bytes left to read from FILE_OBJ, or None if it's not seekable (a pipe)."""
+    try:
+        return os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+    except (IOError, OSError):
+        return None
+
+
+def write_response(response, out, offset=0, progress=False):
+    """
+    Writes a streamed RESPONSE body to OUT in chunks. OFFSET is the number of bytes
+    already downloaded when resuming. Returns the number of bytes written.
+    """
+    length = response.headers.get('content-length')
+    bar = progress_bar(offset + int(length) if length else None) if progress else None
+
+    nbytes = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        if chunk:
+            out.write(chunk)
+            nbytes += len(chunk)
+            if bar is not None:
+                bar.update(offset + nbytes)
+
+    if bar is not None:
+        bar.finish()
+    response.close()
+
+    return nbytes
+
+
+def content_range(response):
+    """Returns the first byte and the total size in the Content-Range of RESPONSE, None if unknown."""
+    match = re.match(r'bytes (?:(\d+)-\d+|\*)/(\d+)', response.headers.get('content-range', ''))
+    if match is None:
+        return None, None
+    start, total = match.groups()
+    return int(start) if start else None, int(total)
+
+
+def validator(response):
+    """Returns the strong ETag or the Last-Modified date of RESPONSE to resume it with If-Range."""
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+
+def file_checksum(path, algorithm):
+    """Returns the hex digest of a local file content with a hashlib ALGORITHM."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SEGMENT_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_s3(response):
+    """Returns True if RESPONSE comes from S3, whose ETags are the MD5 of single part uploads."""
+    return 'x-amz-request-id' in response.headers or \
+        (urlparse(response.url).hostname or '').endswith('.amazonaws.com')
+
+
+def download_path(key):
+    """Returns a fixed temporary path to download KEY to, so an interrupted download is resumed by the next call."""
+    return os.path.join(tempfile.gettempdir(), 'pt-download-' + hashlib.sha1(key).hexdigest())
+
+
+def download_file(url, output, segments=SEGMENTS, checksum=None, progress=False, timeout=DOWNLOAD_TIMEOUT):
+    """
+    Downloads URL to OUTPUT using up to SEGMENTS concurrent Range requests.
+
+    The data goes to OUTPUT.part first and the progress of each segment is kept
+    in OUTPUT.part.json, so an interrupted download is resumed on the next call.
+    Downloads are only resumed if the ETag or Last-Modified date of URL is the same,
+    it's also sent as If-Range so a file replaced in between is downloaded again.
+    The result is verified against CHECKSUM, an (algorithm, hex digest) pair,
+    or against the ETag if S3 served it and it's a plain MD5 (single part uploads).
+    Falls back to a single stream if the server doesn't support ranges.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=segments)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    part_file = output + '.part'
+
+    try:
+        head = session.head(url, allow_redirects=True, timeout=timeout)
+        size = int(head.headers.get('content-length', 0)) if head.ok else 0
+        ranges = head.ok and head.headers.get('accept-ranges') == 'bytes'
+        # Without a validator a partial file can't be told from a different version of the file
+        value = validator(head) if ranges else None
+
+        if checksum is None and head.ok and is_s3(head):
+            etag = head.headers.get('etag', '').strip('"')
+            if re.match('^[0-9a-f]{32}$', etag):
+                checksum = ('md5', etag)
+
+        if ranges and segments > 1 and size >= 2 * MIN_SEGMENT_SIZE:
+            _download_segments(session, head.url, part_file, size, value, segments, progress, timeout)
+        else:
+            _download_stream(session, url, part_file, value, progress, timeout)
+    finally:
+        session.close()
+
+    if checksum is not None:
+        algorithm, expected = checksum
+        actual = file_checksum(part_file, algorithm)
+        if actual != expected.lower():
+            os.remove(part_file)
+            raise Exception('%s checksum mismatch for %s: expected %s, got %s' % (algorithm, url, expected, actual))
+
+    if os.path.exists(output):
+        os.remove(output)
+    os.rename(part_file, output)
+
+    return output
+
+
+def _download_stream(session, url, part_file, value, progress, timeout):
+    """Downloads URL to PART_FILE, resuming it if it was started with the same validator VALUE."""
+    validator_file = part_file + '.validator'
+    offset = 0
+    if value and os.path.exists(part_file) and os.path.exists(validator_file):
+        with open(validator_file, 'rt') as f:
+            if f.read() == value:
+                offset = os.path.getsize(part_file)
+
+    headers = {'Range': 'bytes=%d-' % offset, 'If-Range': value} if offset else {}
+    response = session.get(url, stream=True, headers=headers, timeout=timeout)
+
+    start, total = content_range(response)
+    if response.status_code == 416 and total == offset:
+        # The partial file is already complete
+        response.close()
+    elif response.status_code == 206 and start == offset:
+        with open(part_file, 'ab') as f:
+            write_response(response, f, offset, progress)
+    elif response.status_code == 200:
+        # The file changed or the server ignored the Range header
+        if value:
+            with open(validator_file, 'wt') as f:
+                f.write(value)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+        with open(part_file, 'wb') as f:
+            write_response(response, f, 0, progress)
+    else:
+        response.close()
+        # The partial file doesn't match the remote one, the next attempt starts over
+        for path in (part_file, validator_file):
+            if os.path.exists(path):
+                os.remove(path)
+        response.raise_for_status()
+        raise Exception('Range request failed for %s: %s' % (url, response.status_code))
+
+    if os.path.exists(validator_file):
+        os.remove(validator_file)
+
+
+def _download_segments(session, url, part_file, size, value, segments, progress, timeout):
+    """Downloads URL to PART_FILE in SEGMENTS, resuming them if they were started with the same validator VALUE."""
+    state_file = part_file + '.json'
+    state = None
+
+    if os.path.exists(part_file) and os.path.exists(state_file):
+        try:
+            with open(state_file, 'rt') as f:
+                state = json.load(f)
+        except ValueError:
+            pass
+        if state is None or not value or state.get('validator') != value or state.get('size') != size or \
+                os.path.getsize(part_file) != size:
+            state = None
+
+    if state is None:
+        # [start, end, downloaded bytes] for each segment
+        step = size // segments
+        bounds = [i * step for i in range(segments)] + [size]
+        state = {'size': size, 'validator': value,
+                 'segments': [[bounds[i], bounds[i + 1] - 1, 0] for i in range(segments)]}
+        with open(part_file, 'wb') as f:
+            f.truncate(size)
+
+    lock = threading.Lock()
+    bar = progress_bar(size) if progress else None
+    downloaded = [sum(segment[2] for segment in state['segments'])]
+    changed = [False]
+
+    def save_state():
+        if not changed[0]:
+            with open(state_file, 'wt') as f:
+                json.dump(state, f)
+
+    def fetch(segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+
+        response = session.get(url, stream=True, timeout=timeout,
+                               headers={'Range': 'bytes=%d-%d' % (start + done, end), 'If-Range': value})
+        if response.status_code != 206 or content_range(response) != (start + done, size):
+            response.close()
+            # The file changed since the download started, the next attempt starts over
+            with lock:
+                changed[0] = True
+                if os.path.exists(state_file):
+                    os.remove(state_file)
+            raise Exception('Range request failed for %s: %s' % (url, response.status_code))
+
+        with open(part_file, 'r+b') as f:
+            f.seek(start + done)
+            for chunk in response.iter_content(SEGMENT_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    with lock:
+                        segment[2] += len(chunk)
+                        downloaded[0] += len(chunk)
+                        if bar is not None:
+                            bar.update(downloaded[0])
+                        save_state()
+        response.close()
+
+    pool = ThreadPool(segments)
+    try:
+        pool.map(fetch, state['segments'])
+    finally:
+        pool.close()
+        pool.join()
+
+    if bar is not None:
+        bar.finish()
+
+    for start, end, done in state['segments']:
+        if start + done <= end:
+            raise Exception('Incomplete download of %s' % url)
+
+    os.remove(state_file)
+
+
+class UploadStream:
+    """
+    A file-like request body concatenating byte strings and file objects.
+
+    If the length of every part is known requests sends it with a Content-Length header,
+    otherwise (a pipe) with a chunked transfer encoding, reading it in small blocks
+    instead of buffering it in memory.
+    """
+
+    def __init__(self, parts, progress=False):
+        self.parts = list(parts)
+        sizes = [len(part) if isinstance(part, bytes) else file_size(part) for part in self.parts]
+        self.length = None if None in sizes else sum(sizes)
+        self.sent = 0
+        self.progress = progress_bar(self.length) if progress else None
+
+    def __len__(self):
+        # requests sends a body without a length chunked
+        return self.length or 0
+
+    def __nonzero__(self):
+        # requests skips bodies which are false
+        return True
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=CHUNK_SIZE):
+        while self.parts:
+            part = self.parts[0]
+            if isinstance(part, bytes):
+                chunk, self.parts[0] = part[:size], part[size:]
+            else:
+                chunk = part.read(size)
+
+            if chunk:
+                self.sent += len(chunk)
+                if self.progress is not None:
+                    self.progress.update(self.sent)
+                    if self.sent == self.length:
+                        self.progress.finish()
+                return chunk
+
+            self.parts.pop(0)
+
+        if self.progress is not None and self.length is None:
+            self.progress.finish()
+            self.progress = None
+        return b''
+
+
+class MultipartUploadStream(UploadStream):
+    """A multipart/form-data body with a single file field, streamed from FILE_OBJ."""
+
+    def __init__(self, field, filename, file_obj, content_type='application/octet-stream', progress=False):
+        self.boundary = uuid.uuid4().hex
+        head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                'Content-Type: %s\r\n\r\n') % (self.boundary, field, filename, content_type)
+        tail = '\r\n--%s--\r\n' % self.boundary
+        UploadStream.__init__(self, [head.encode('utf-8'), file_obj, tail.encode('utf-8')], progress)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
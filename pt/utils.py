@@ -6,6 +6,9 @@ import os, os.path
 import datetime as dt
 import threading
 import sys
+import json
+import tempfile
+from contextlib import contextmanager
 
 class Timer:
 
@@ -38,29 +41,131 @@ def print_ok(str):
 def print_fail(str):
     sys.stderr.write(bgcolors.FAIL + str + bgcolors.ENDC)
 
-def load_site_config(site):
+
+def print_fail_line(message):
+    """
+    Writes a failure MESSAGE as one line, joining its lines (such as those of a server error),
+    as print_fail of commons only writes the first line of a message.
+    """
+    print_fail(message.replace('\n', ' '))
+    sys.stderr.write('\n')
+
+
+def replace_file(source, destination):
+    """Renames SOURCE to DESTINATION, replacing it if it exists (which os.rename refuses on Windows)."""
+    if os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+    os.rename(source, destination)
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Yields a temporary file which replaces the file at PATH once the block completes,
+    so readers never see a partial file. The temporary file is removed if the block fails.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        replace_file(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+# Directories searched for site configs, in order
+SITES_PATH = os.getenv('PT_SITES_PATH', os.pathsep.join(['.', 'sites', os.path.join(os.path.expanduser('~'), '.pt', 'sites')]))
+SITES_INDEX = os.path.join(os.path.expanduser('~'), '.pt', 'sites.json')
+# Commands run on several sites find their configs concurrently
+sites_index_lock = threading.Lock()
+
+
+def parse_site_config(path):
+    """
+    Parses a site config written by `pt login` (NUL separated KEY=value pairs)
+    or a shell file with one (optionally exported and quoted) KEY=value per line.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    env = {}
+    if '\0' in content:
+        # Values are written as they are, they may have spaces or quotes
+        for pair in content.split('\0'):
+            if '=' in pair:
+                key, value = pair.split('=', 1)
+                env[key] = value
+        return env
+
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[len('export '):].strip()
+        if '=' not in line:
+            continue
+
+        key, value = line.split('=', 1)
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+            value = value[1:-1]
+        env[key.strip()] = value
+    return env
+
+
+def load_sites_index():
+    try:
+        with open(SITES_INDEX, 'rt') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def register_site(site, path):
+    """Records where the config of a SITE used from the current directory is."""
+    with sites_index_lock:
+        index = load_sites_index()
+        index[os.path.join(os.getcwd(), site)] = os.path.abspath(path)
+        with atomic_write(SITES_INDEX, 'wt') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+
+
+def find_site_config(site):
+    """
+    Returns the path of a SITE config file. Looks it up in the index of known sites first,
+    then in the SITES_PATH directories.
+    """
+    path = load_sites_index().get(os.path.join(os.getcwd(), site))
+    if path is not None and os.path.isfile(path):
+        return path
+
     path = None
+    if os.path.isfile(site):
+        path = site
+    else:
+        for directory in SITES_PATH.split(os.pathsep):
+            if os.path.isfile(os.path.join(directory, site)):
+                path = os.path.join(directory, site)
+                break
 
-    for root, dirs, files in os.walk('.'):
-        if site in files:
-            path = os.path.join(root, site)
+    if path is not None:
+        register_site(site, path)
+    return path
 
-    if path is None:
-        return None
 
-    env, error = subprocess.Popen(['/bin/bash', '-c', 'source %s && env -0' % path], stdout=subprocess.PIPE).communicate()
-    return {val[0]: val[1] for val in map(lambda line: line.split('=', 1), env.split('\0')) if len(val) == 2}
+def load_site_config(site):
+    path = find_site_config(site)
 
+    if path is None:
+        return None
 
-def download_file(url, local_filename):
-    # NOTE the stream=True parameter
-    r = requests.get(url, stream=True)
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-           if chunk: # filter out keep-alive new chunks
-               f.write(chunk)
-               #f.flush() commented by recommendation from J.F.Sebastian
-    return local_filename
+    return parse_site_config(path)
 
 
 def execute(command, async=False,  env=os.environ):
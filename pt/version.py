@@ -7,7 +7,9 @@ import os
 from os.path import exists
 
 import requests
-import progressbar
+
+from transfer import download_file
+from cache import ArtifactCache
 
 S3_BUCKET = "https://s3.amazonaws.com/papertrail"
 
@@ -28,30 +30,18 @@ def store_local_version(build):
     with open(LOCAL_VERSION_PATH, 'w') as f:
         f.write(build)
 
-def download(build, output, extension = INSTALLER_EXTENSION):
-    """Downloads a specific version of the Papertrail installation package."""
+def download(build, output, extension = INSTALLER_EXTENSION, cache = True):
+    """
+    Downloads a specific version of the Papertrail installation package.
+    Packages are kept in the local artifact cache, so a build is only downloaded once.
+    """
     url = (S3_BUCKET + "/public/nightly/build/Papertrail_%s.%s") % (build, extension)
     print(url)
 
-    response = requests.get(url, stream=True)
-    size = response.headers['content-length']
-
-    with open(output, 'wb') as f:
-        progress = progressbar.ProgressBar(max_value=int(size),
-                                           widgets = [ progressbar.DataSize(), progressbar.Bar(), ' ',
-                                                       progressbar.FileTransferSpeed(), ' | ',
-                                                       progressbar.Timer(), ', ',
-                                                       progressbar.ETA() ])
-        nbytes = 0
-
-        for chunk in response.iter_content(4096):
-            if chunk:
-                nbytes += len(chunk)
-
-                progress.update(nbytes)
-                f.write(chunk)
-
-    response.close()
+    if cache:
+        ArtifactCache().fetch('papertrail/%s.%s' % (build, extension), url, output, progress=True)
+    else:
+        download_file(url, output, progress=True)
 
 def get_build(version_identifier):
     """Retrieves a build and version number."""
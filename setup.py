@@ -32,13 +32,16 @@ setup(
     name='papertrail-cli',
     version='1.1.' + buildNumber,
     install_requires=requirements,
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     author='Egis Software',
     url='https://github.com/egis/papertrail-python-cli',
     description='Papertrail Command Line Utils',
     packages=find_packages(),
     entry_points={
         "console_scripts": [
-            "pt = pt.pt:main",
+            "pt = pt.daemon:main",
         ]
     }
 )